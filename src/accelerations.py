@@ -3,21 +3,21 @@
 
 # Author: Leonardo Quinonez
 
+# Only numpy is imported here. The numba, jax, taichi and Barnes-Hut versions live in their own
+# modules (accelerations_numba.py, ...) that are imported the first time one of their functions
+# is used, through acceleration_functions_dic, compute_accelerations or accelerations.<name>.
+
 
 import sys
 import time
+import json
+import argparse
+import importlib
+import importlib.util
+from collections import OrderedDict
+from collections.abc import Mapping
 import numpy as np
 
-## Numba
-import numba
-from numba import njit, prange
-
-import jax.numpy as jnp
-import jax
-
-## Taichi
-import taichi as ti
-
 # Implement acceleration just using pythonic loops
 def get_acceleration_naive_loops(X: np.ndarray) -> np.ndarray:
     acceleration = np.zeros(X.shape)
@@ -51,204 +51,345 @@ def get_acceleration_numpy(X: np.ndarray) -> np.ndarray:
 
 
 
-
-@njit
-def get_acceleration_naive_loops_numba(X: np.ndarray) -> np.ndarray:
-    acceleration = np.zeros(X.shape)
-    for i in range(len(X)):
-
-        sum = np.zeros(3)
-        for j in range(len(X)):
-            if i == j:
-                continue
-            diff = X[j] - X[i]
-            cube = np.linalg.norm(diff) ** 3
-            sum = sum + diff / cube
-
-        acceleration[i] = -sum
-
-    return acceleration
-
-# Run one time to make jit compile the code
-# print("Numba loops:",validate_acceleration(get_acceleration_naive_loops_numba, get_acceleration_numpy, a))
-
-
-
-# Use the same code as above just changing range for prange and setting the njit property
-@njit(parallel=True)
-def get_acceleration_numba_parallel(X: np.ndarray) -> np.ndarray:
-    acceleration = np.zeros(X.shape)
-    for i in prange(len(X)):
-
-        sum = np.zeros(3)
-        for j in range(len(X)):
-            if i == j:
-                continue
-            diff = X[j] - X[i]
-            cube = np.linalg.norm(diff) ** 3
-            sum = sum + diff / cube
-
-        acceleration[i] = -sum
+# Same broadcasting but by blocks of tile_size x tile_size bodies.
+# The N x N x 3 temporary is replaced by scratch buffers allocated once and reused for every tile,
+# so the memory is O(N + tile_size^2) instead of O(N^2).
+# Optional masses and softening (Plummer softening length) are used by compute_accelerations.
+def get_acceleration_numpy_tiled(X: np.ndarray, tile_size: int = 512, masses: np.ndarray = None, softening: float = 0.0) -> np.ndarray:
+    N = len(X)
+    tile_size = max(1, min(tile_size, N))
+    acceleration = np.zeros(X.shape, dtype=X.dtype)
+
+    diff_buffer = np.empty((tile_size, tile_size, 3), dtype=X.dtype)
+    distance_buffer = np.empty((tile_size, tile_size), dtype=X.dtype)
+    inv_cube_buffer = np.empty((tile_size, tile_size), dtype=X.dtype)
+
+    for i_start in range(0, N, tile_size):
+        i_end = min(i_start + tile_size, N)
+        for j_start in range(0, N, tile_size):
+            j_end = min(j_start + tile_size, N)
+
+            # Views of the buffers for the last (smaller) tiles
+            vec_diff = diff_buffer[: i_end - i_start, : j_end - j_start]
+            distance_sqr = distance_buffer[: i_end - i_start, : j_end - j_start]
+            inv_cube = inv_cube_buffer[: i_end - i_start, : j_end - j_start]
+
+            np.subtract(X[i_start:i_end, np.newaxis], X[np.newaxis, j_start:j_end], out=vec_diff)
+            np.einsum("ijk,ijk->ij", vec_diff, vec_diff, out=distance_sqr)
+            if softening:
+                distance_sqr += softening**2
+            np.sqrt(distance_sqr, out=inv_cube)
+            np.multiply(inv_cube, distance_sqr, out=inv_cube)
+
+            # Set distance 0 to inf to avoid dividing by 0
+            inv_cube[inv_cube == 0] = np.inf
+            np.reciprocal(inv_cube, out=inv_cube)
+            if masses is not None:
+                inv_cube *= masses[np.newaxis, j_start:j_end]
+
+            # Weighted sum over j without the tile x tile x 3 quotient
+            acceleration[i_start:i_end] += np.einsum("ijk,ij->ik", vec_diff, inv_cube)
 
     return acceleration
 
-# Run one time to make jit compile the code
-# print("Numba parallel:",validate_acceleration(get_acceleration_numba_parallel, get_acceleration_numpy, a))
-
 
 
-@jax.jit # Dont use the annotation to be able to compile for gpu and cpu
-def get_acceleration_jax_vmap(X: np.ndarray) -> np.ndarray:
-    N = len(X)
-
-    def get_i(i):  # Kernel executed in parallel
+#-------------------------------
+# Backend modules, imported on first use
+
+# module -> packages it needs, available_functions() only looks for them without importing
+backend_dependencies = {
+    "accelerations_numba": ["numba"],
+    "accelerations_jax": ["jax"],
+    "accelerations_taichi": ["taichi"],
+    "barnes_hut": ["numba"],
+    "particle_mesh": [],
+    "accelerations_distributed": ["numba"],
+}
+
+# function name (without get_acceleration_) -> module, None for the ones in this file
+acceleration_function_modules = OrderedDict([
+    ("naive_loops", None),
+    ("numpy", None),
+    ("numpy_tiled", None),
+    ("naive_loops_numba", "accelerations_numba"),
+    ("numba_parallel", "accelerations_numba"),
+    ("numba_symmetric", "accelerations_numba"),
+    ("numba_parallel_symmetric", "accelerations_numba"),
+    ("numba_soa", "accelerations_numba"),
+    ("numba_soa_f32", "accelerations_numba"),
+    ("jax_vmap", "accelerations_jax"),
+    ("jax_map", "accelerations_jax"),
+    ("jax3", "accelerations_jax"),
+    ("jax_chunked", "accelerations_jax"),
+    # ("jax_gpu", "accelerations_jax"),
+    ("taichi", "accelerations_taichi"),
+    ("taichi_engine", "accelerations_taichi"),
+    ("taichi_symmetric", "accelerations_taichi"),
+    ("barnes_hut", "barnes_hut"),
+    ("particle_mesh", "particle_mesh"),
+    ("distributed", "accelerations_distributed"),
+])
+
+# Other names of the backend modules reachable as accelerations.<name>
+lazy_attributes = {
+    "get_acceleration_numba_softened": "accelerations_numba",
+    "get_acceleration_numba_soa_softened": "accelerations_numba",
+    "get_acceleration_jax_softened": "accelerations_jax",
+    "TaichiAccelerationEngine": "accelerations_taichi",
+    "taichi_engine": "accelerations_taichi",
+    "taichi_engine_symmetric": "accelerations_taichi",
+    "get_acceleration_distributed_softened": "accelerations_distributed",
+    "DistributedEngine": "accelerations_distributed",
+    "LocalComm": "accelerations_distributed",
+    "ring_accelerations": "accelerations_distributed",
+}
+for _name, _module in acceleration_function_modules.items():
+    if _module is not None:
+        lazy_attributes["get_acceleration_" + _name] = _module
+
+
+def load_backend(module_name: str):
+    # Works both in the package (tests) and as a script: python accelerations.py
+    if __package__:
+        return importlib.import_module("." + module_name, __package__)
+    return importlib.import_module(module_name)
+
+
+def backend_available(module_name: str) -> bool:
+    # Without importing (or initializing) anything
+    if module_name is None:
+        return True
+    return all(importlib.util.find_spec(package) is not None for package in backend_dependencies[module_name])
+
+
+def available_functions() -> list:
+    return [name for name, module in acceleration_function_modules.items() if backend_available(module)]
+
+
+def __getattr__(name: str):
+    # accelerations.get_acceleration_numba_parallel, accelerations.TaichiAccelerationEngine, ... load their module
+    if name in lazy_attributes:
+        return getattr(load_backend(lazy_attributes[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_acceleration_function(name: str):
+    module = acceleration_function_modules[name]
+    if module is None:
+        return globals()["get_acceleration_" + name]
+    return getattr(load_backend(module), "get_acceleration_" + name)
+
+
+class LazyFunctions(Mapping):
+    # Name -> function like a dict, the module of a function is imported when it is looked up
+    def __getitem__(self, name: str):
+        if name not in acceleration_function_modules:
+            raise KeyError(name)
+        return get_acceleration_function(name)
+
+    def __iter__(self):
+        return iter(acceleration_function_modules)
+
+    def __len__(self):
+        return len(acceleration_function_modules)
+
+
+acceleration_functions_dic = LazyFunctions()
+
+
+def set_jax_x64(enabled: bool = True):
+    load_backend("accelerations_jax").set_jax_x64(enabled)
+
+
+def set_distributed_workers(n_workers: int):
+    # Processes of the distributed function (default one per cpu)
+    load_backend("accelerations_distributed").set_workers(n_workers)
 
-        vec_diff = X - X[i]
-        distance_matrix = jnp.linalg.norm(vec_diff, axis=1) ** 3
-        acceleration = vec_diff / distance_matrix[:, jnp.newaxis]
 
-        return -jnp.nansum(acceleration, axis=0)
+def set_taichi_arch(arch: str):
+    # cpu, gpu (default), cuda, vulkan, metal or opengl, before the first taichi computation
+    load_backend("accelerations_taichi").set_arch(arch)
 
-    # Parallel loop using jax.vmap
-    return jax.vmap(get_i)(jnp.arange(N))  # Vectorized version for parallel execution
 
 
-# Ensure use of 64 bits vs the default of 32 bits
-# jax.config.update("jax_enable_x64", True)
+#-------------------------------
+# Unified API: same semantics (masses, softening and dtype) for every backend.
+# The functions in the list above keep the unit masses and no softening used for the benchmarks.
 
 
+def _numpy_backend(X, masses, softening):
+    return get_acceleration_numpy_tiled(X, masses=masses, softening=softening)
 
-# For using with gpu - run in another notebook in colab
-# Colab only allows two cores so the parallelization is not effective there.
-# from: https://github.com/jax-ml/jax/issues/1598#issuecomment-548031576
-# get_acceleration_jax_cpu = jax.jit(get_acceleration_jax, backend='cpu')
-# get_acceleration_jax_gpu = jax.jit(get_acceleration_jax, backend="gpu")
 
+def _numba_backend(X, masses, softening):
+    numba_backend = load_backend("accelerations_numba")
+    return numba_backend.get_acceleration_numba_softened(X, masses, X.dtype.type(softening**2))
 
 
-from jax import lax
-# Using lax map because of memory issues with vmap
-# https://apxml.com/courses/getting-started-with-jax/chapter-4-automatic-vectorization-vmap/vmap-performance
-# https://docs.jax.dev/en/latest/_autosummary/jax.lax.map.html
-@jax.jit # Dont use the annotation to be able to compile for gpu and cpu
-def get_acceleration_jax_map(X: np.ndarray) -> np.ndarray:
-    N = len(X)
+def _numba_soa_backend(X, masses, softening):
+    return load_backend("accelerations_numba").get_acceleration_numba_soa_softened(X, masses, softening)
 
-    def get_i(i):  # Kernel executed in parallel
 
-        vec_diff = X - X[i]
-        
-        distance_matrix = jnp.linalg.norm(vec_diff, axis=1) ** 3
-        # jax.debug.print("{x}", x=vec_diff.shape)
-        acceleration = vec_diff / distance_matrix[:, jnp.newaxis]
+def _jax_backend(X, masses, softening, batch_size: int = 256):
+    jax_backend = load_backend("accelerations_jax")
+    if X.dtype == np.float64 and not jax_backend.jax.config.jax_enable_x64:
+        raise ValueError("The jax backend needs jax_enable_x64 for float64, see set_jax_x64")
+    result = jax_backend.get_acceleration_jax_softened(X, masses, softening**2, batch_size=batch_size)
+    return np.asarray(result.block_until_ready())
 
-        return -jnp.nansum(acceleration, axis=0)
 
-    # Parallel loop using jax.vmap
-    return lax.map(get_i, jnp.arange(N))  # Vectorized version for parallel execution
+def _taichi_backend(X, masses, softening):
+    return load_backend("accelerations_taichi").engine_for_dtype(X.dtype)(X, masses, softening)
 
-# An attempt to use vmap with smaller intermediate arrays
-@jax.jit # Dont use the annotation to be able to compile for gpu and cpu
-def get_acceleration_jax3(X: np.ndarray) -> np.ndarray:
-    N = len(X)
 
-    def get_i(i):  # Kernel executed in parallel
+def _barnes_hut_backend(X, masses, softening, theta: float = 0.5):
+    # The tree is always built in float64
+    return load_backend("barnes_hut").get_acceleration_barnes_hut(X, theta=theta, masses=masses, softening=softening)
 
-        for j in range(len(X)):
-            if i == j:
-                continue
-            diff = X[j] - X[i]
-            cube = jnp.linalg.norm(diff) ** 3
-            sum = sum + diff / cube
 
-        return -sum
+def _particle_mesh_backend(X, masses, softening, grid_size: int = 64, box_size: float = None):
+    # The mesh is always computed in float64
+    return load_backend("particle_mesh").get_acceleration_particle_mesh(X, grid_size, masses=masses, softening=softening, box_size=box_size)
 
-    # Parallel loop using jax.vmap
-    return jax.vmap(get_i, jnp.arange(N))  # Vectorized version for parallel execution
 
+def _distributed_backend(X, masses, softening):
+    # The blocks are always float64
+    return load_backend("accelerations_distributed").get_acceleration_distributed_softened(X, masses, softening)
 
 
+compute_backends = {
+    "numpy": _numpy_backend,
+    "numba": _numba_backend,
+    "numba_soa": _numba_soa_backend,
+    "jax": _jax_backend,
+    "taichi": _taichi_backend,
+    "barnes_hut": _barnes_hut_backend,
+    "particle_mesh": _particle_mesh_backend,
+    "distributed": _distributed_backend,
+}
 
-# ti.init(arch=ti.cpu, default_fp=ti.f32)  # Use GPU (or ti.cpu for CPU)
-ti.init(arch=ti.gpu, default_fp=ti.f32)  # Use GPU (or ti.cpu for CPU)
-# ti.init(arch=ti.gpu)  # Use GPU (or ti.cpu for CPU)
-# ti.get_runtime().core.set_capability(ti.core.Capability.vulkan_64bit)
 
+def compute_accelerations(X: np.ndarray, masses: np.ndarray = None, softening: float = 0.0, dtype=np.float64, backend: str = "numpy", **kwargs) -> np.ndarray:
+    """
+    Accelerations of N bodies with positions X (N, 3) using one of compute_backends.
 
-def get_acceleration_taichi(X: np.ndarray) -> np.ndarray:
-    X = X.astype(np.float32)
-    n=X.shape[0]
+    a_i = sum_j m_j (x_i - x_j) / (|x_i - x_j|^2 + softening^2)^(3/2)
+    with the same sign as the get_acceleration_* functions, masses default to 1.
+    The computation and the result use dtype (np.float32 or np.float64),
+    extra keyword arguments go to the backend (e.g. theta for barnes_hut, grid_size for particle_mesh).
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"dtype must be float32 or float64, got {dtype}")
+    if backend not in compute_backends:
+        raise ValueError(f"{backend} not in backends: {list(compute_backends)}")
 
-    positions = ti.Vector.field(3, dtype=ti.f32, shape=n)
-    acceleration = ti.Vector.field(3, dtype=ti.f32, shape=n)
-    
-    positions.from_numpy(X)
+    X = np.ascontiguousarray(X, dtype=dtype)
+    if masses is None:
+        masses = np.ones(len(X), dtype=dtype)
+    else:
+        masses = np.ascontiguousarray(masses, dtype=dtype)
+        if masses.shape != (len(X),):
+            raise ValueError(f"masses shape {masses.shape} doesn't match {len(X)} bodies")
 
+    result = compute_backends[backend](X, masses, softening, **kwargs)
+    return np.asarray(result, dtype=dtype)
 
-    @ti.kernel
-    def compute_acceleration():
-        n = positions.shape[0]
-        for i in positions:
-            sum_force = ti.math.vec3(0.0)
-            for j in range(n):
-                if i != j:
-                    r = positions[j] - positions[i]
-                    r_norm = r.norm()
-                    # sum_force += r / (r_norm**3 + 1e-5*r_norm**2)
-                    sum_force += r / (r_norm**3 )
-            acceleration[i] = -sum_force
-    
-    compute_acceleration()
-    return acceleration.to_numpy()
 
 
 #-------------------------------
+# Benchmark: python accelerations.py <function> <N> [--repetitions R] [--json]
 
+repetitions = 3
 
-acceleration_functions = [
-    get_acceleration_naive_loops,
-    get_acceleration_numpy,
-    get_acceleration_naive_loops_numba,
-    get_acceleration_numba_parallel,
-    get_acceleration_jax,
-    get_acceleration_jax2,
-    get_acceleration_jax3,
-    # get_acceleration_jax_gpu
-    get_acceleration_taichi,
-]
 
-acceleration_functions_dic = {f.__name__.replace("get_acceleration_",""):f   for f in acceleration_functions}
+def wait_for_result(result):
+    # jax runs asynchronously, taichi and numpy are done once the numpy array is returned
+    if hasattr(result, "block_until_ready"):
+        result.block_until_ready()
+    return result
+
+
+def benchmark_function(f_name: str, N: int, repetitions: int = repetitions, seed: int = None) -> dict:
+    # The first call is timed apart since it includes the jit compilation (numba, jax, taichi),
+    # the steady state statistics only use the following calls.
+    if f_name not in acceleration_functions_dic:
+        raise KeyError(f"{f_name} not in functions: {list(acceleration_functions_dic)}")
+    function = acceleration_functions_dic[f_name]
+
+    rng = np.random.default_rng(seed)
+    X = rng.random((N, 3))
+
+    start_time = time.perf_counter()
+    wait_for_result(function(X))
+    first_call = time.perf_counter() - start_time
+
+    durations = []
+    for i in range(repetitions):
+        start_time = time.perf_counter()
+        wait_for_result(function(X))
+        durations.append(time.perf_counter() - start_time)
+
+    median = float(np.median(durations))
+    return {
+        "function": f_name,
+        "N": N,
+        "repetitions": repetitions,
+        "first_call_s": first_call,
+        "compile_s": max(first_call - median, 0.0),
+        "median_s": median,
+        "min_s": float(np.min(durations)),
+        "max_s": float(np.max(durations)),
+        "std_s": float(np.std(durations)),
+        # Pairwise interactions of the direct sum, also for approximate methods to compare them
+        "interactions_per_s": N * (N - 1) / median if median > 0 else float("inf"),
+        "durations_s": durations,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark one of the acceleration functions")
+    parser.add_argument("function", help=f"One of: {', '.join(acceleration_functions_dic)}")
+    parser.add_argument("N", type=int, help="Number of bodies")
+    parser.add_argument("-r", "--repetitions", type=int, default=repetitions, help="Timed calls after the warmup")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="Print the results as json")
+    parser.add_argument("-o", "--output", default=None, help="Append the results as a json line to this file")
+    parser.add_argument("--x64", action="store_true", help="Enable float64 in jax")
+    parser.add_argument("--taichi-arch", default=None, help="cpu, gpu (default), cuda, vulkan, metal or opengl")
+    parser.add_argument("--workers", type=int, default=None, help="Processes of the distributed function (default one per cpu)")
+    args = parser.parse_args(argv)
+
+    if args.x64:
+        set_jax_x64(True)
+    if args.taichi_arch:
+        set_taichi_arch(args.taichi_arch)
+    if args.workers:
+        set_distributed_workers(args.workers)
+
+    try:
+        result = benchmark_function(args.function, args.N, args.repetitions, args.seed)
+    except Exception as e:
+        print(f"{type(e).__name__}: {e}")
+        return 1
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(
+            f"{result['function']} N={result['N']:_} first call (with compile): {result['first_call_s']:.4g}s "
+            f"min/max: {result['min_s']:.4g}/{result['max_s']:.4g}s "
+            f"interactions/s: {result['interactions_per_s']:.3e} median:"
+        )
+        # Median last so the output can still be parsed with stdout.split()[-1]
+        print(result["median_s"])
+    return 0
 
-repetitions = 3
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2:
-        try:
-            f_name = str(sys.argv[1])
-            N = int(sys.argv[2])
-
-            if f_name not in acceleration_functions_dic:
-                print(f"{f_name} not in functions: {acceleration_functions_dic.keys()}")
-                sys.exit(1)
-
-            s = 0
-            durations = []
-            for i in range(repetitions):
-                X = np.random.rand(N, 3)
-                start_time = time.time()
-                result = acceleration_functions_dic[f_name](X)
-                if("jax" in  f_name):
-                    # Ensure wait to finish
-                    result.block_until_ready()
-                duration = time.time() - start_time
-                durations.append(duration)
-
-            print(np.median(durations))
-
-        except Exception as e:
-            print(f"{type(e).__name__}: {e}")
-            sys.exit(1)
-    else:
-        print("Arguments: function and N")
-        sys.exit(1)
-    
\ No newline at end of file
+    sys.exit(main())
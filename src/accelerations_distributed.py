@@ -0,0 +1,378 @@
+# Distributed direct N-Body summation (see accelerations.py)
+# The bodies are split in blocks over worker processes and the blocks travel around a ring
+# (systolic ring), every worker only holds its own block and the one it is computing with:
+#   step k: worker r computes its block against block (r - k) % size while it sends that block to
+#   r + 1 and receives the next one from r - 1. The messages are sent in the background, so the
+#   communication overlaps with the computation (the numba kernel releases the GIL).
+# ring_accelerations only uses Get_rank, Get_size, Isend, Irecv, Wait and Barrier of an mpi4py
+# communicator, the same code runs with:
+# * LocalComm: the processes of DistributedEngine on this machine, the blocks go through shared memory
+# * MPI.COMM_WORLD: mpiexec -n 4 python accelerations_distributed.py 100000 --mpi (several nodes)
+
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
+
+import numpy as np
+import numba
+from numba import njit, prange
+
+if __package__:
+    from .accelerations_numba import soa_fastmath
+else:
+    from accelerations_numba import soa_fastmath
+
+
+# Blocks are (4, B) arrays: rows x, y, z and mass, the padding bodies have mass 0
+@njit(parallel=True, nogil=True, fastmath=soa_fastmath, error_model="numpy")
+def accumulate_block(i_block, n_i, j_block, softening_sqr, acceleration):
+    # acceleration[:, i] += contribution of every body of j_block, same sign as accelerations.py
+    for i in prange(n_i):
+        xi = i_block[0, i]
+        yi = i_block[1, i]
+        zi = i_block[2, i]
+        sum_x = 0.0
+        sum_y = 0.0
+        sum_z = 0.0
+        for j in range(j_block.shape[1]):
+            dx = xi - j_block[0, j]
+            dy = yi - j_block[1, j]
+            dz = zi - j_block[2, j]
+            distance_sqr = dx * dx + dy * dy + dz * dz + softening_sqr
+            # r^2 = 0 (the body itself or padding on top of it) adds nothing, see numba_soa_kernel
+            inv_distance = 1.0 / np.sqrt(distance_sqr + 1.0 * (distance_sqr == 0))
+            factor = j_block[3, j] * inv_distance * inv_distance * inv_distance
+            sum_x += dx * factor
+            sum_y += dy * factor
+            sum_z += dz * factor
+        acceleration[0, i] += sum_x
+        acceleration[1, i] += sum_y
+        acceleration[2, i] += sum_z
+
+
+def ring_accelerations(comm, block: np.ndarray, n_local: int, softening: float = 0.0) -> np.ndarray:
+    # Accelerations (3, B) of the first n_local bodies of this rank's block, every rank passes a block of the same shape
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    block = np.ascontiguousarray(block, dtype=np.float64)
+    # Copy: the buffers are overwritten by the blocks received, the own block stays for the whole ring
+    current = block.copy()
+    incoming = np.empty_like(current)
+    acceleration = np.zeros((3, current.shape[1]))
+
+    for step in range(size):
+        requests = []
+        if step < size - 1:
+            # The block being computed is also the one being sent, both only read it
+            requests = [comm.Isend(current, dest=(rank + 1) % size), comm.Irecv(incoming, source=(rank - 1) % size)]
+        accumulate_block(block, n_local, current, softening**2, acceleration)
+        for request in requests:
+            request.Wait()
+        current, incoming = incoming, current
+    return acceleration
+
+
+#-------------------------------
+# Local stand-in for MPI
+
+
+class LocalRequest:
+    # Same Wait() as an mpi4py request, the copy runs on a thread
+    def __init__(self, target):
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(target,), daemon=True)
+        self.thread.start()
+
+    def run(self, target):
+        try:
+            target()
+        except Exception as e:
+            self.error = e
+
+    def Wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class LocalComm:
+    # The part of an mpi4py communicator used by ring_accelerations, between the processes of DistributedEngine.
+    # Every rank has one mailbox in shared memory guarded by two semaphores: messages are received in
+    # the order they were sent whatever the source, enough for the ring (every rank only hears its left neighbour).
+    def __init__(self, rank: int, size: int, mailboxes: np.ndarray, full, empty, barrier):
+        self.rank = rank
+        self.size = size
+        self.mailboxes = mailboxes
+        self.full = full
+        self.empty = empty
+        self.barrier = barrier
+
+    def Get_rank(self) -> int:
+        return self.rank
+
+    def Get_size(self) -> int:
+        return self.size
+
+    def Isend(self, buffer: np.ndarray, dest: int, tag: int = 0) -> LocalRequest:
+        def send():
+            self.empty[dest].acquire()
+            self.mailboxes[dest, :buffer.size] = buffer.ravel()
+            self.full[dest].release()
+        return LocalRequest(send)
+
+    def Irecv(self, buffer: np.ndarray, source: int = -1, tag: int = 0) -> LocalRequest:
+        def receive():
+            self.full[self.rank].acquire()
+            buffer.ravel()[:] = self.mailboxes[self.rank, :buffer.size]
+            self.empty[self.rank].release()
+        return LocalRequest(receive)
+
+    def Barrier(self):
+        self.barrier.wait()
+
+
+def buffer_shapes(size: int, block_capacity: int):
+    # positions and masses, accelerations and the mailboxes of LocalComm
+    return [(4, size * block_capacity), (3, size * block_capacity), (size, 4 * block_capacity)]
+
+
+def run_task(rank: int, size: int, arrays, N: int, softening: float, full, empty, barrier) -> float:
+    # One call of DistributedEngine on this rank, returns the seconds spent in the ring
+    positions, output, mailboxes = arrays
+    block_size = -(-N // size)
+    start = rank * block_size
+    n_local = max(0, min(block_size, N - start))
+    block = positions[:, start:start + block_size].copy()
+    comm = LocalComm(rank, size, mailboxes, full, empty, barrier)
+
+    start_time = time.perf_counter()
+    acceleration = ring_accelerations(comm, block, n_local, softening)
+    output[:, start:start + n_local] = acceleration[:, :n_local]
+    return time.perf_counter() - start_time
+
+
+def worker_main(rank: int, size: int, connection, full, empty, barrier, threads: int):
+    # Loop of a worker process: one task per call of DistributedEngine, None to stop
+    numba.set_num_threads(threads)
+    names = None
+    memories = []
+    arrays = []
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        try:
+            task_names, N, block_capacity, softening = task
+            if task_names != names:
+                # New buffers (bigger N), the views have to go before their segments are closed
+                arrays = []
+                for memory in memories:
+                    memory.close()
+                memories = [shared_memory.SharedMemory(name=name) for name in task_names]
+                arrays = [np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+                          for shape, memory in zip(buffer_shapes(size, block_capacity), memories)]
+                names = task_names
+            connection.send(("ok", run_task(rank, size, arrays, N, softening, full, empty, barrier)))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+    arrays = []
+    for memory in memories:
+        memory.close()
+
+
+class DistributedEngine:
+    # Pool of worker processes kept alive between calls, the positions and accelerations are shared
+    # memory (4, size * block_capacity) and (3, ...) arrays reallocated when N goes over the capacity.
+    def __init__(self, n_workers: int = None, threads_per_worker: int = 1, start_method: str = "spawn"):
+        # spawn: fork is not safe once the numba threads of this process are running
+        self.n_workers = n_workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker
+        self.context = multiprocessing.get_context(start_method)
+        self.processes = []
+        self.memories = []
+        self.arrays = []
+        self.block_capacity = 0
+        # Seconds spent in the ring by every worker in the last call
+        self.worker_times = []
+
+    def start(self):
+        size = self.n_workers
+        # Kept here, the spawned workers open them by name when they start (after start() returns)
+        self.full = [self.context.Semaphore(0) for _ in range(size)]
+        self.empty = [self.context.Semaphore(1) for _ in range(size)]
+        self.barrier = self.context.Barrier(size)
+        self.connections = []
+        for rank in range(size):
+            parent, child = self.context.Pipe()
+            args = (rank, size, child, self.full, self.empty, self.barrier, self.threads_per_worker)
+            process = self.context.Process(target=worker_main, args=args, daemon=True)
+            process.start()
+            # Only the worker keeps its end, a worker that dies closes the pipe (EOF / broken pipe here)
+            child.close()
+            self.processes.append(process)
+            self.connections.append(parent)
+
+    def ensure_buffers(self, N: int):
+        block_size = -(-N // self.n_workers)
+        if block_size <= self.block_capacity:
+            return
+        self.free_buffers()
+        # Powers of two so growing N doesn't reallocate every call
+        self.block_capacity = 1 << max(block_size - 1, 0).bit_length()
+        shapes = buffer_shapes(self.n_workers, self.block_capacity)
+        self.memories = [shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8) for shape in shapes]
+        self.arrays = [np.ndarray(shape, dtype=np.float64, buffer=memory.buf) for shape, memory in zip(shapes, self.memories)]
+
+    def __call__(self, X: np.ndarray, masses: np.ndarray = None, softening: float = 0.0) -> np.ndarray:
+        if not self.processes:
+            self.start()
+        N = len(X)
+        self.ensure_buffers(N)
+        positions, output, _ = self.arrays
+        positions[:3, :N] = X.T
+        positions[3, :N] = 1.0 if masses is None else masses
+        # Padding bodies without mass
+        positions[:, N:] = 0.0
+
+        names = tuple(memory.name for memory in self.memories)
+        self.worker_times = self.run_workers((names, N, self.block_capacity, float(softening)))
+        return output[:, :N].T.copy()
+
+    def run_workers(self, task) -> list:
+        # Reply of every rank. A rank that fails (or dies) leaves its neighbours waiting on the semaphores
+        # of the ring forever, the whole pool is then terminated (started again by the next call).
+        replies = {}
+        try:
+            for connection in self.connections:
+                connection.send(task)
+            pending = list(self.connections)
+            while pending:
+                for connection in multiprocessing.connection.wait(pending):
+                    pending.remove(connection)
+                    status, message = connection.recv()
+                    if status == "error":
+                        raise RuntimeError(f"Distributed worker {self.connections.index(connection)} failed: {message}")
+                    replies[connection] = message
+        except (OSError, EOFError) as e:
+            self.terminate()
+            raise RuntimeError(f"Distributed worker exited: {type(e).__name__}: {e}") from e
+        except RuntimeError:
+            self.terminate()
+            raise
+        return [replies[connection] for connection in self.connections]
+
+    def terminate(self):
+        # Kills the workers (e.g. stuck in the ring), the semaphores are in an unknown state so
+        # start() makes new ones. The shared memory buffers are kept.
+        for process in self.processes:
+            process.kill()
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+
+    def free_buffers(self):
+        self.arrays = []
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+        self.block_capacity = 0
+
+    def close(self):
+        for connection in self.connections if self.processes else []:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.free_buffers()
+
+
+# Engine of get_acceleration_distributed, started on the first call
+workers = None
+engine = None
+
+
+def set_workers(n_workers: int):
+    # Worker processes of get_acceleration_distributed (default: one per cpu), restarts the pool
+    global workers, engine
+    workers = n_workers
+    if engine is not None:
+        engine.close()
+        engine = None
+
+
+def get_engine() -> DistributedEngine:
+    global engine
+    if engine is None:
+        engine = DistributedEngine(workers)
+        atexit.register(engine.close)
+    return engine
+
+
+def get_acceleration_distributed(X: np.ndarray) -> np.ndarray:
+    return get_engine()(np.asarray(X, dtype=np.float64))
+
+
+def get_acceleration_distributed_softened(X: np.ndarray, masses: np.ndarray, softening: float = 0.0) -> np.ndarray:
+    return get_engine()(np.asarray(X, dtype=np.float64), masses, softening)
+
+
+#-------------------------------
+# MPI: mpiexec -n <ranks> python accelerations_distributed.py <N> --mpi
+
+
+def mpi_main(argv=None):
+    from mpi4py import MPI
+
+    parser = argparse.ArgumentParser(description="Distributed direct summation with MPI")
+    parser.add_argument("N", type=int)
+    parser.add_argument("-r", "--repetitions", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--softening", type=float, default=0.0)
+    parser.add_argument("--mpi", action="store_true")
+    args = parser.parse_args(argv)
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    # Every rank draws the same bodies and keeps its block, nothing to scatter
+    X = np.random.default_rng(args.seed).random((args.N, 3))
+    block_size = -(-args.N // size)
+    start = rank * block_size
+    n_local = max(0, min(block_size, args.N - start))
+    block = np.zeros((4, block_size))
+    block[:3, :n_local] = X[start:start + n_local].T
+    block[3, :n_local] = 1.0
+
+    durations = []
+    # The first call compiles the kernel
+    for _ in range(args.repetitions + 1):
+        comm.Barrier()
+        start_time = time.perf_counter()
+        acceleration = ring_accelerations(comm, block, n_local, args.softening)
+        comm.Barrier()
+        durations.append(time.perf_counter() - start_time)
+
+    blocks = comm.gather(acceleration[:, :n_local].T, root=0)
+    if rank == 0:
+        median = float(np.median(durations[1:]))
+        print(json.dumps({
+            "function": "distributed_mpi", "N": args.N, "workers": size, "first_call_s": durations[0],
+            "median_s": median, "interactions_per_s": args.N * (args.N - 1) / median,
+            "max_abs_acceleration": float(np.abs(np.concatenate(blocks)).max()),
+        }))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(mpi_main())
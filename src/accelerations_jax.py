@@ -0,0 +1,114 @@
+# JAX versions of the direct N-Body summation (see accelerations.py)
+# Imported by accelerations.py the first time one of them is used.
+
+from functools import partial
+
+import numpy as np
+import jax.numpy as jnp
+import jax
+from jax import lax
+
+
+@jax.jit # Dont use the annotation to be able to compile for gpu and cpu
+def get_acceleration_jax_vmap(X: np.ndarray) -> np.ndarray:
+    N = len(X)
+
+    def get_i(i):  # Kernel executed in parallel
+
+        vec_diff = X - X[i]
+        distance_matrix = jnp.linalg.norm(vec_diff, axis=1) ** 3
+        acceleration = vec_diff / distance_matrix[:, jnp.newaxis]
+
+        return -jnp.nansum(acceleration, axis=0)
+
+    # Parallel loop using jax.vmap
+    return jax.vmap(get_i)(jnp.arange(N))  # Vectorized version for parallel execution
+
+
+# Ensure use of 64 bits vs the default of 32 bits
+# jax.config.update("jax_enable_x64", True)  # or set_jax_x64() below
+
+
+
+# For using with gpu - run in another notebook in colab
+# Colab only allows two cores so the parallelization is not effective there.
+# from: https://github.com/jax-ml/jax/issues/1598#issuecomment-548031576
+# get_acceleration_jax_cpu = jax.jit(get_acceleration_jax, backend='cpu')
+# get_acceleration_jax_gpu = jax.jit(get_acceleration_jax, backend="gpu")
+
+
+
+# Using lax map because of memory issues with vmap
+# https://apxml.com/courses/getting-started-with-jax/chapter-4-automatic-vectorization-vmap/vmap-performance
+# https://docs.jax.dev/en/latest/_autosummary/jax.lax.map.html
+@jax.jit # Dont use the annotation to be able to compile for gpu and cpu
+def get_acceleration_jax_map(X: np.ndarray) -> np.ndarray:
+    N = len(X)
+
+    def get_i(i):  # Kernel executed in parallel
+
+        vec_diff = X - X[i]
+        
+        distance_matrix = jnp.linalg.norm(vec_diff, axis=1) ** 3
+        # jax.debug.print("{x}", x=vec_diff.shape)
+        acceleration = vec_diff / distance_matrix[:, jnp.newaxis]
+
+        return -jnp.nansum(acceleration, axis=0)
+
+    # Parallel loop using jax.vmap
+    return lax.map(get_i, jnp.arange(N))  # Vectorized version for parallel execution
+
+# An attempt to use vmap with smaller intermediate arrays
+# The loop over j is a lax.fori_loop so every i only keeps its 3 component sum
+@jax.jit # Dont use the annotation to be able to compile for gpu and cpu
+def get_acceleration_jax3(X: np.ndarray) -> np.ndarray:
+    N = len(X)
+
+    def get_i(i):  # Kernel executed in parallel
+
+        def add_j(j, sum):
+            diff = X[j] - X[i]
+            distance_sqr = jnp.sum(diff**2)
+            cube = jnp.where(i == j, 1, distance_sqr * jnp.sqrt(distance_sqr))
+            return sum + jnp.where(i == j, 0, diff / cube)
+
+        return -lax.fori_loop(0, N, add_j, jnp.zeros(3, dtype=X.dtype))
+
+    # Parallel loop using jax.vmap
+    return jax.vmap(get_i)(jnp.arange(N))  # Vectorized version for parallel execution
+
+
+
+# vmap is fast but keeps the N x 3 temporaries of all the rows at once, lax.map only one row at a time.
+# lax.map with batch_size runs sequentially over batches of rows and vmaps inside every batch,
+# so the memory is O(batch_size * N). jax.jit compiles once per (N, batch_size).
+def _jax_chunked_rows(X, masses, softening_sqr, batch_size):
+    N = len(X)
+
+    def get_i(i):
+        vec_diff = X - X[i]
+        distance_sqr = jnp.sum(vec_diff**2, axis=1) + softening_sqr
+        # Zero distances (the body itself without softening) don't contribute
+        safe_distance_sqr = jnp.where(distance_sqr == 0, 1, distance_sqr)
+        factor = jnp.where(distance_sqr == 0, 0, masses / (safe_distance_sqr * jnp.sqrt(safe_distance_sqr)))
+
+        return -jnp.sum(vec_diff * factor[:, jnp.newaxis], axis=0)
+
+    return lax.map(get_i, jnp.arange(N), batch_size=min(batch_size, N))
+
+
+@partial(jax.jit, static_argnames=("batch_size",))
+def get_acceleration_jax_chunked(X: np.ndarray, batch_size: int = 256) -> np.ndarray:
+    return _jax_chunked_rows(X, jnp.ones(len(X), dtype=X.dtype), 0, batch_size)
+
+
+# Masses and softening for compute_accelerations.
+# float64 needs jax_enable_x64 (see set_jax_x64), otherwise jax computes in float32.
+@partial(jax.jit, static_argnames=("batch_size",))
+def get_acceleration_jax_softened(X: np.ndarray, masses: np.ndarray, softening_sqr: float, batch_size: int = 256) -> np.ndarray:
+    return _jax_chunked_rows(X, masses, softening_sqr, batch_size)
+
+
+def set_jax_x64(enabled: bool = True):
+    # Has to be called before creating the arrays, jax uses float32 by default
+    jax.config.update("jax_enable_x64", enabled)
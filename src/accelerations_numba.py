@@ -0,0 +1,208 @@
+# Numba versions of the direct N-Body summation (see accelerations.py)
+# Imported by accelerations.py the first time one of them is used, the @njit functions
+# are compiled on their first call.
+
+import numpy as np
+import numba
+from numba import njit, prange
+
+
+@njit
+def get_acceleration_naive_loops_numba(X: np.ndarray) -> np.ndarray:
+    acceleration = np.zeros(X.shape)
+    for i in range(len(X)):
+
+        sum = np.zeros(3)
+        for j in range(len(X)):
+            if i == j:
+                continue
+            diff = X[j] - X[i]
+            cube = np.linalg.norm(diff) ** 3
+            sum = sum + diff / cube
+
+        acceleration[i] = -sum
+
+    return acceleration
+
+# Run one time to make jit compile the code
+# print("Numba loops:",validate_acceleration(get_acceleration_naive_loops_numba, get_acceleration_numpy, a))
+
+
+
+# Use the same code as above just changing range for prange and setting the njit property
+@njit(parallel=True)
+def get_acceleration_numba_parallel(X: np.ndarray) -> np.ndarray:
+    acceleration = np.zeros(X.shape)
+    for i in prange(len(X)):
+
+        sum = np.zeros(3)
+        for j in range(len(X)):
+            if i == j:
+                continue
+            diff = X[j] - X[i]
+            cube = np.linalg.norm(diff) ** 3
+            sum = sum + diff / cube
+
+        acceleration[i] = -sum
+
+    return acceleration
+
+# Run one time to make jit compile the code
+# print("Numba parallel:",validate_acceleration(get_acceleration_numba_parallel, get_acceleration_numpy, a))
+
+
+
+# Symmetric versions (Newton's third law): each pair is computed once and the
+# contribution is added to i and subtracted from j, half the sqrt and divisions of the loops above.
+@njit
+def get_acceleration_numba_symmetric(X: np.ndarray) -> np.ndarray:
+    N = len(X)
+    sum = np.zeros((N, 3))
+    for i in range(N):
+        for j in range(i + 1, N):
+            dx = X[j, 0] - X[i, 0]
+            dy = X[j, 1] - X[i, 1]
+            dz = X[j, 2] - X[i, 2]
+            distance_sqr = dx * dx + dy * dy + dz * dz
+            inv_cube = 1.0 / (distance_sqr * np.sqrt(distance_sqr))
+
+            sum[i, 0] += dx * inv_cube
+            sum[i, 1] += dy * inv_cube
+            sum[i, 2] += dz * inv_cube
+            sum[j, 0] -= dx * inv_cube
+            sum[j, 1] -= dy * inv_cube
+            sum[j, 2] -= dz * inv_cube
+
+    return -sum
+
+
+# Parallel version, every thread scatters into its own buffer to avoid races on sum[j]
+# and the buffers are reduced at the end. Memory is O(threads * N).
+@njit(parallel=True)
+def get_acceleration_numba_parallel_symmetric(X: np.ndarray) -> np.ndarray:
+    N = len(X)
+    n_threads = numba.get_num_threads()
+    partial_sums = np.zeros((n_threads, N, 3))
+
+    for t in prange(n_threads):
+        # Interleaved rows so every thread gets a similar part of the triangle
+        for i in range(t, N, n_threads):
+            sum_x = 0.0
+            sum_y = 0.0
+            sum_z = 0.0
+            for j in range(i + 1, N):
+                dx = X[j, 0] - X[i, 0]
+                dy = X[j, 1] - X[i, 1]
+                dz = X[j, 2] - X[i, 2]
+                distance_sqr = dx * dx + dy * dy + dz * dz
+                inv_cube = 1.0 / (distance_sqr * np.sqrt(distance_sqr))
+
+                sum_x += dx * inv_cube
+                sum_y += dy * inv_cube
+                sum_z += dz * inv_cube
+                partial_sums[t, j, 0] -= dx * inv_cube
+                partial_sums[t, j, 1] -= dy * inv_cube
+                partial_sums[t, j, 2] -= dz * inv_cube
+
+            partial_sums[t, i, 0] += sum_x
+            partial_sums[t, i, 1] += sum_y
+            partial_sums[t, i, 2] += sum_z
+
+    acceleration = np.empty((N, 3))
+    for i in prange(N):
+        for k in range(3):
+            total = 0.0
+            for t in range(n_threads):
+                total += partial_sums[t, i, k]
+            acceleration[i, k] = -total
+
+    return acceleration
+
+
+
+# Masses and softening for compute_accelerations.
+# There are no float literals in the loop so it runs in the dtype of X (f32 or f64).
+@njit(parallel=True)
+def get_acceleration_numba_softened(X: np.ndarray, masses: np.ndarray, softening_sqr) -> np.ndarray:
+    N = len(X)
+    acceleration = np.empty_like(X)
+    for i in prange(N):
+        zero = X[i, 0] - X[i, 0]
+        sum_x = zero
+        sum_y = zero
+        sum_z = zero
+        for j in range(N):
+            dx = X[j, 0] - X[i, 0]
+            dy = X[j, 1] - X[i, 1]
+            dz = X[j, 2] - X[i, 2]
+            distance_sqr = dx * dx + dy * dy + dz * dz + softening_sqr
+            if distance_sqr == 0:
+                continue
+            factor = masses[j] / (distance_sqr * np.sqrt(distance_sqr))
+            sum_x += dx * factor
+            sum_y += dy * factor
+            sum_z += dz * factor
+
+        acceleration[i, 0] = -sum_x
+        acceleration[i, 1] = -sum_y
+        acceleration[i, 2] = -sum_z
+
+    return acceleration
+
+
+
+# Structure of arrays version: x, y and z in their own contiguous arrays and scalar accumulators,
+# so the inner loop only does loads, multiplies and adds that LLVM can vectorize (the loops above
+# allocate diff and sum for every pair).
+# * error_model="numpy": the default python model checks every division for ZeroDivisionError,
+#   that branch alone keeps the loop scalar
+# * fastmath without nnan / ninf: reassociating the sums allows the SIMD reduction and 1 / sqrt
+#   becomes vrsqrtps + a Newton step in f32 (f64 keeps sqrt and div)
+# * no branch for i == j: r^2 = 0 is replaced by 1 and dx = dy = dz = 0 anyway
+soa_fastmath = {"contract", "arcp", "reassoc", "afn", "nsz"}
+
+
+@njit(parallel=True, fastmath=soa_fastmath, error_model="numpy")
+def numba_soa_kernel(x, y, z, masses, softening_sqr, one, acceleration):
+    # one (and softening_sqr) have the dtype of x, a float literal would turn the f32 loop into f64
+    N = len(x)
+    for i in prange(N):
+        xi = x[i]
+        yi = y[i]
+        zi = z[i]
+        sum_x = xi - xi
+        sum_y = sum_x
+        sum_z = sum_x
+        for j in range(N):
+            dx = xi - x[j]
+            dy = yi - y[j]
+            dz = zi - z[j]
+            distance_sqr = dx * dx + dy * dy + dz * dz + softening_sqr
+            inv_distance = one / np.sqrt(distance_sqr + one * (distance_sqr == 0))
+            factor = masses[j] * inv_distance * inv_distance * inv_distance
+            sum_x += dx * factor
+            sum_y += dy * factor
+            sum_z += dz * factor
+
+        acceleration[i, 0] = sum_x
+        acceleration[i, 1] = sum_y
+        acceleration[i, 2] = sum_z
+
+
+def get_acceleration_numba_soa_softened(X: np.ndarray, masses: np.ndarray, softening: float = 0.0) -> np.ndarray:
+    # Runs in the dtype of X (f32 or f64), the (N, 3) layout is only used for the input and the result
+    dtype = X.dtype.type
+    x, y, z = (np.ascontiguousarray(X[:, k]) for k in range(3))
+    acceleration = np.empty_like(X)
+    numba_soa_kernel(x, y, z, masses.astype(dtype, copy=False), dtype(softening**2), dtype(1), acceleration)
+    return acceleration
+
+
+def get_acceleration_numba_soa(X: np.ndarray) -> np.ndarray:
+    return get_acceleration_numba_soa_softened(X, np.ones(len(X), dtype=X.dtype))
+
+
+def get_acceleration_numba_soa_f32(X: np.ndarray) -> np.ndarray:
+    # Twice the SIMD lanes of f64, the result is converted back to the dtype of X
+    X_32 = X.astype(np.float32)
+    return get_acceleration_numba_soa(X_32).astype(X.dtype)
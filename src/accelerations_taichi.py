@@ -0,0 +1,234 @@
+# Taichi versions of the direct N-Body summation (see accelerations.py)
+# Imported by accelerations.py the first time one of them is used. Taichi is initialized by the first
+# computation (not by the import) on the arch of set_arch, so the import works on nodes without gpu.
+# init() is also the one of taichi/taichi_gravity.py, both share the taichi runtime of the process.
+
+from collections import OrderedDict
+
+import numpy as np
+import taichi as ti
+from taichi._lib import core as ti_core
+from taichi.lang import impl
+
+archs = {
+    "cpu": ti.cpu,
+    "gpu": ti.gpu,
+    "cuda": ti.cuda,
+    "vulkan": ti.vulkan,
+    "metal": ti.metal,
+    "opengl": ti.opengl,
+}
+
+# ti.gpu picks an available gpu backend and falls back to the cpu
+arch = "gpu"
+
+
+def current_arch():
+    # The arch taichi runs on in this process, whoever called ti.init (None before the first one)
+    if impl.get_runtime().prog is None:
+        return None
+    return impl.current_cfg().arch
+
+
+def same_arch(requested, initialized) -> bool:
+    # Without probing the backends (slow, it can even crash on some drivers),
+    # ti.gpu is a list of gpu backends and falls back to the cpu
+    if isinstance(requested, (list, tuple)):
+        return initialized in requested or initialized == ti.cpu
+    return requested == initialized
+
+
+def init(requested=ti.gpu, **kwargs):
+    # ti.init resets taichi and frees every field created before (also the ones of a taichi_gravity.Simulation),
+    # so it only runs once per process and later calls check that they want the same arch
+    initialized = current_arch()
+    if initialized is None:
+        ti.init(arch=requested, **kwargs)
+    elif not same_arch(requested, initialized):
+        raise RuntimeError(f"Taichi is already initialized on {ti_core.arch_name(initialized)}")
+
+
+def set_arch(name: str):
+    # Has to be called before the first computation, ti.init again would free every field
+    global arch
+    if name not in archs:
+        raise ValueError(f"{name} not in archs: {list(archs)}")
+    initialized = current_arch()
+    if initialized is not None and not same_arch(archs[name], initialized):
+        raise RuntimeError(f"Taichi is already initialized on {ti_core.arch_name(initialized)}")
+    arch = name
+
+
+def ensure_initialized():
+    init(archs[arch], default_fp=ti.f32)
+    # ti.get_runtime().core.set_capability(ti.core.Capability.vulkan_64bit)
+
+
+def get_acceleration_taichi(X: np.ndarray) -> np.ndarray:
+    ensure_initialized()
+    X = X.astype(np.float32)
+    n=X.shape[0]
+
+    positions = ti.Vector.field(3, dtype=ti.f32, shape=n)
+    acceleration = ti.Vector.field(3, dtype=ti.f32, shape=n)
+    
+    positions.from_numpy(X)
+
+
+    @ti.kernel
+    def compute_acceleration():
+        n = positions.shape[0]
+        for i in positions:
+            sum_force = ti.math.vec3(0.0)
+            for j in range(n):
+                if i != j:
+                    r = positions[j] - positions[i]
+                    r_norm = r.norm()
+                    # sum_force += r / (r_norm**3 + 1e-5*r_norm**2)
+                    sum_force += r / (r_norm**3 )
+            acceleration[i] = -sum_force
+    
+    compute_acceleration()
+    return acceleration.to_numpy()
+
+
+
+# Same kernel as above but the fields and the compiled kernel are kept between calls.
+# get_acceleration_taichi allocates two fields and compiles a new kernel every call which
+# is slower than the computation itself for small N in a time stepping loop.
+# Fields are allocated by capacity (next power of 2) so N can change without reallocating every time,
+# the kernels are compiled once per capacity and the least recently used capacities are freed.
+@ti.data_oriented
+class TaichiAccelerationEngine:
+    def __init__(self, max_cached: int = 4, min_capacity: int = 1024, symmetric: bool = False, dtype=ti.f32):
+        # symmetric computes every pair once and scatters the opposite contribution with atomics
+        self.symmetric = symmetric
+        # ti.f64 works on cpu and cuda but not on every gpu backend
+        self.dtype = dtype
+        self.max_cached = max_cached
+        self.min_capacity = min_capacity
+        # capacity -> (snode_tree, positions, masses, acceleration) in least recently used order
+        self.cache = OrderedDict()
+
+    def get_fields(self, n: int):
+        ensure_initialized()
+        capacity = max(self.min_capacity, 1 << (n - 1).bit_length())
+        if capacity in self.cache:
+            self.cache.move_to_end(capacity)
+            _, positions, masses, acceleration = self.cache[capacity]
+            return positions, masses, acceleration
+
+        # FieldsBuilder allows to free the memory of the fields once evicted
+        fb = ti.FieldsBuilder()
+        positions = ti.Vector.field(3, dtype=self.dtype)
+        masses = ti.field(dtype=self.dtype)
+        acceleration = ti.Vector.field(3, dtype=self.dtype)
+        fb.dense(ti.i, capacity).place(positions, masses, acceleration)
+        self.cache[capacity] = (fb.finalize(), positions, masses, acceleration)
+
+        while len(self.cache) > self.max_cached:
+            _, (snode_tree, _, _, _) = self.cache.popitem(last=False)
+            snode_tree.destroy()
+
+        return positions, masses, acceleration
+
+    @ti.kernel
+    def load_positions(self, X: ti.types.ndarray(), positions: ti.template(), n: ti.i32):
+        for i in range(n):
+            positions[i] = ti.Vector([X[i, 0], X[i, 1], X[i, 2]])
+
+    @ti.kernel
+    def load_masses(self, m: ti.types.ndarray(), masses: ti.template(), n: ti.i32):
+        for i in range(n):
+            masses[i] = m[i]
+
+    @ti.kernel
+    def fill_masses(self, masses: ti.template(), value: ti.f32, n: ti.i32):
+        for i in range(n):
+            masses[i] = value
+
+    @ti.kernel
+    def store_acceleration(self, acceleration: ti.template(), out: ti.types.ndarray(), n: ti.i32):
+        for i in range(n):
+            for k in ti.static(range(3)):
+                out[i, k] = acceleration[i][k]
+
+    @ti.kernel
+    def compute_acceleration(self, positions: ti.template(), masses: ti.template(), acceleration: ti.template(), n: ti.i32, softening_sqr: ti.f32):
+        eps_sqr = ti.cast(softening_sqr, self.dtype)
+        for i in range(n):
+            sum_force = ti.Vector.zero(self.dtype, 3)
+            for j in range(n):
+                if i != j:
+                    r = positions[j] - positions[i]
+                    r_norm_sqr = r.norm_sqr() + eps_sqr
+                    sum_force += masses[j] * r / (r_norm_sqr * ti.sqrt(r_norm_sqr))
+            acceleration[i] = -sum_force
+
+    @ti.kernel
+    def compute_acceleration_symmetric(self, positions: ti.template(), masses: ti.template(), acceleration: ti.template(), n: ti.i32, softening_sqr: ti.f32):
+        eps_sqr = ti.cast(softening_sqr, self.dtype)
+        for i in range(n):
+            acceleration[i] = ti.Vector.zero(self.dtype, 3)
+        for i in range(n):
+            sum_force = ti.Vector.zero(self.dtype, 3)
+            for j in range(i + 1, n):
+                r = positions[j] - positions[i]
+                r_norm_sqr = r.norm_sqr() + eps_sqr
+                force = r / (r_norm_sqr * ti.sqrt(r_norm_sqr))
+                sum_force += masses[j] * force
+                # Atomic add since other threads also write to j
+                ti.atomic_add(acceleration[j], masses[i] * force)
+            ti.atomic_sub(acceleration[i], sum_force)
+
+    def compute_in_place(self, positions, masses, acceleration, n: int = None, softening: float = 0.0):
+        # For fields that are already on the device, no copies from or to numpy
+        if n is None:
+            n = positions.shape[0]
+        if self.symmetric:
+            self.compute_acceleration_symmetric(positions, masses, acceleration, n, softening**2)
+        else:
+            self.compute_acceleration(positions, masses, acceleration, n, softening**2)
+
+    def __call__(self, X: np.ndarray, masses: np.ndarray = None, softening: float = 0.0) -> np.ndarray:
+        ensure_initialized()
+        np_dtype = np.float64 if self.dtype == ti.f64 else np.float32
+        X = np.ascontiguousarray(X, dtype=np_dtype)
+        n = X.shape[0]
+        positions, masses_field, acceleration = self.get_fields(n)
+
+        self.load_positions(X, positions, n)
+        if masses is None:
+            self.fill_masses(masses_field, 1.0, n)
+        else:
+            self.load_masses(np.ascontiguousarray(masses, dtype=np_dtype), masses_field, n)
+        self.compute_in_place(positions, masses_field, acceleration, n, softening)
+
+        result = np.empty((n, 3), dtype=np_dtype)
+        self.store_acceleration(acceleration, result, n)
+        return result
+
+
+taichi_engine = TaichiAccelerationEngine()
+
+
+def get_acceleration_taichi_engine(X: np.ndarray) -> np.ndarray:
+    return taichi_engine(X)
+
+
+taichi_engine_symmetric = TaichiAccelerationEngine(symmetric=True)
+
+
+def get_acceleration_taichi_symmetric(X: np.ndarray) -> np.ndarray:
+    return taichi_engine_symmetric(X)
+
+
+taichi_engines = {}
+
+
+def engine_for_dtype(dtype) -> TaichiAccelerationEngine:
+    # One engine per dtype for compute_accelerations, their fields and kernels are reused between calls
+    dtype = ti.f64 if dtype == np.float64 else ti.f32
+    if dtype not in taichi_engines:
+        taichi_engines[dtype] = TaichiAccelerationEngine(dtype=dtype)
+    return taichi_engines[dtype]
@@ -0,0 +1,243 @@
+# Barnes-Hut tree code
+# O(N log N) approximation of the N-Body accelerations using an octree.
+# Follows the conventions of accelerations.py: unit masses, no softening and
+# the same sign of the returned accelerations, masses and softening are optional.
+
+import numpy as np
+from numba import njit, prange
+
+# Subdividing further than this only happens for (almost) coincident bodies,
+# those are kept together in a linked list on the same leaf.
+MAX_DEPTH = 48
+
+EMPTY = -1
+
+
+# Leafs are stored in the children array as negative numbers to tell them apart from nodes.
+@njit(inline="always")
+def _encode_body(b):
+    return -b - 2
+
+
+@njit(inline="always")
+def _octant(x, center):
+    octant = 0
+    if x[0] > center[0]:
+        octant |= 1
+    if x[1] > center[1]:
+        octant |= 2
+    if x[2] > center[2]:
+        octant |= 4
+    return octant
+
+
+@njit
+def build_octree(X, root_center, root_half, children, centers, half_sizes, next_body):
+    # Insert the bodies one by one starting from the root.
+    # Returns the number of nodes used or -1 if the arrays are too small.
+    max_nodes = children.shape[0]
+
+    children[0, :] = EMPTY
+    centers[0] = root_center
+    half_sizes[0] = root_half
+    n_nodes = 1
+
+    for b in range(len(X)):
+        next_body[b] = EMPTY
+        node = 0
+        depth = 0
+        while True:
+            octant = _octant(X[b], centers[node])
+            child = children[node, octant]
+
+            if child == EMPTY:
+                children[node, octant] = _encode_body(b)
+                break
+
+            if child >= 0:
+                node = child
+                depth += 1
+                continue
+
+            # The octant is a leaf with another body
+            if depth >= MAX_DEPTH:
+                # Chain the body with the ones already there
+                other = -child - 2
+                next_body[b] = next_body[other]
+                next_body[other] = b
+                break
+
+            if n_nodes >= max_nodes:
+                return -1
+
+            new_node = n_nodes
+            n_nodes += 1
+            quarter = 0.5 * half_sizes[node]
+            children[new_node, :] = EMPTY
+            half_sizes[new_node] = quarter
+            for k in range(3):
+                sign = 1.0 if (octant >> k) & 1 else -1.0
+                centers[new_node, k] = centers[node, k] + sign * quarter
+
+            # Move the existing body one level down and try again
+            other = -child - 2
+            children[new_node, _octant(X[other], centers[new_node])] = child
+            children[node, octant] = new_node
+            node = new_node
+            depth += 1
+
+    return n_nodes
+
+
+@njit
+def compute_mass_distribution(X, body_masses, children, n_nodes, next_body, masses, com):
+    # Children are always created after their parent so a reverse pass goes bottom-up.
+    for node in range(n_nodes - 1, -1, -1):
+        mass = 0.0
+        weighted = np.zeros(3)
+        for octant in range(8):
+            child = children[node, octant]
+            if child == EMPTY:
+                continue
+            if child >= 0:
+                mass += masses[child]
+                weighted += masses[child] * com[child]
+            else:
+                b = -child - 2
+                while b != EMPTY:
+                    mass += body_masses[b]
+                    weighted += body_masses[b] * X[b]
+                    b = next_body[b]
+        masses[node] = mass
+        if mass > 0:
+            com[node] = weighted / mass
+        else:
+            com[node] = 0.0
+
+
+@njit(parallel=True)
+def walk_octree(X, body_masses, softening_sqr, theta, children, half_sizes, next_body, masses, com):
+    acceleration = np.zeros(X.shape)
+    theta_sqr = theta * theta
+    for i in prange(len(X)):
+        xi = X[i]
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+
+        stack = np.empty(8 * MAX_DEPTH + 8, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+
+            dx = com[node, 0] - xi[0]
+            dy = com[node, 1] - xi[1]
+            dz = com[node, 2] - xi[2]
+            dist_sqr = dx * dx + dy * dy + dz * dz
+            size = 2.0 * half_sizes[node]
+
+            # Opening criterion, far enough nodes are approximated by their center of mass
+            if size * size < theta_sqr * dist_sqr:
+                dist_sqr += softening_sqr
+                factor = masses[node] / (dist_sqr * np.sqrt(dist_sqr))
+                ax += dx * factor
+                ay += dy * factor
+                az += dz * factor
+                continue
+
+            for octant in range(8):
+                child = children[node, octant]
+                if child == EMPTY:
+                    continue
+                if child >= 0:
+                    stack[top] = child
+                    top += 1
+                    continue
+
+                b = -child - 2
+                while b != EMPTY:
+                    dx = X[b, 0] - xi[0]
+                    dy = X[b, 1] - xi[1]
+                    dz = X[b, 2] - xi[2]
+                    dist_sqr = dx * dx + dy * dy + dz * dz
+                    # Skips the body itself and coincident ones like the numpy version
+                    if dist_sqr > 0.0:
+                        dist_sqr += softening_sqr
+                        factor = body_masses[b] / (dist_sqr * np.sqrt(dist_sqr))
+                        ax += dx * factor
+                        ay += dy * factor
+                        az += dz * factor
+                    b = next_body[b]
+
+        acceleration[i, 0] = -ax
+        acceleration[i, 1] = -ay
+        acceleration[i, 2] = -az
+
+    return acceleration
+
+
+def spread_bits(v: np.ndarray) -> np.ndarray:
+    # 21 bits of v to every third bit of a uint64
+    x = v.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in ((32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)):
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def morton_order(X: np.ndarray) -> np.ndarray:
+    # Permutation sorting the bodies along a Morton (Z-order) curve of their bounding box, 21 bits per axis.
+    # Same keys as Simulation.sort_morton in taichi_gravity.py
+    lower = X.min(axis=0)
+    extent = np.maximum(X.max(axis=0) - lower, 1e-30)
+    cells = np.clip((X - lower) / extent * 2097151, 0, 2097151).astype(np.uint32)
+    keys = spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << np.uint64(1)) | (spread_bits(cells[:, 2]) << np.uint64(2))
+    return np.argsort(keys, kind="stable")
+
+
+def get_acceleration_barnes_hut(X: np.ndarray, theta: float = 0.5, masses: np.ndarray = None, softening: float = 0.0,
+                                sort: bool = True) -> np.ndarray:
+    # theta is the opening angle: 0 gives the exact direct sum, bigger is faster and less accurate.
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    N = len(X)
+    body_masses = np.ones(N) if masses is None else np.ascontiguousarray(masses, dtype=np.float64)
+
+    # Bodies inserted and walked in Morton order: consecutive bodies go down the same branches of the tree
+    # and the threads of the walk open the same nodes (about twice as fast for a Plummer model)
+    order = None
+    if sort and N > 1:
+        order = morton_order(X)
+        X = X[order]
+        body_masses = body_masses[order]
+
+    # Root cube enclosing all the bodies
+    lower = X.min(axis=0)
+    upper = X.max(axis=0)
+    root_center = 0.5 * (lower + upper)
+    root_half = 0.5 * (upper - lower).max() * (1 + 1e-6) + 1e-12
+
+    # Uniform distributions need less than N nodes, start with some headroom and grow if needed
+    max_nodes = max(2 * N, 64)
+    while True:
+        children = np.empty((max_nodes, 8), dtype=np.int64)
+        centers = np.empty((max_nodes, 3))
+        half_sizes = np.empty(max_nodes)
+        next_body = np.empty(N, dtype=np.int64)
+        n_nodes = build_octree(X, root_center, root_half, children, centers, half_sizes, next_body)
+        if n_nodes > 0:
+            break
+        max_nodes *= 2
+
+    masses = np.empty(n_nodes)
+    com = np.empty((n_nodes, 3))
+    compute_mass_distribution(X, body_masses, children, n_nodes, next_body, masses, com)
+
+    acceleration = walk_octree(X, body_masses, softening**2, theta, children, half_sizes, next_body, masses, com)
+    if order is None:
+        return acceleration
+    # Back to the order of the input
+    result = np.empty_like(acceleration)
+    result[order] = acceleration
+    return result
@@ -0,0 +1,264 @@
+# Scaling study of the acceleration functions
+# Every (function, N) runs in its own process (python accelerations.py <function> <N> --json)
+# that is killed when it goes over the memory or time limits.
+# Moved from PerformanceComparison.ipynb so it can run headless:
+#   python benchmark_suite.py --functions numpy numba_parallel --max-mem-mb 10240 --max-time 10
+# Strong and weak scaling of the distributed function over the number of worker processes:
+#   python benchmark_suite.py --scaling strong --workers 1 2 4 8 --n 50000
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+import psutil
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "accelerations.py")
+
+csv_columns = ["function", "N", "status", "wall_s", "median_s", "first_call_s", "compile_s", "peak_rss_mb", "interactions_per_s"]
+scaling_columns = ["mode", "function", "workers", "N", "status", "median_s", "interactions_per_s", "speedup", "efficiency"]
+
+
+def kill_tree(proc: psutil.Process):
+    # The workers of the distributed function too, killed with the parent they would keep running
+    # (SIGKILL skips their cleanup) and keep the stdout pipe open
+    processes = [proc]
+    try:
+        processes += proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        pass
+    for p in processes:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(processes, timeout=10)
+
+
+def time_algorithm_with_limits(function_name: str, N: int, max_mem_mb=1024, max_time_sec=10, repetitions=3, poll_interval=0.1,
+                               extra_args=()) -> dict:
+    # extra_args go to accelerations.py, e.g. ["--workers", "4"]
+    process = subprocess.Popen(
+        [sys.executable, script_path, function_name, str(N), "--json", "--repetitions", str(repetitions), *extra_args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    start_time = time.perf_counter()
+
+    status = "ok"
+    peak_mem = 0.0
+    proc = psutil.Process(process.pid)
+    try:
+        while process.poll() is None:
+            # With the worker processes of the distributed function
+            mem = sum(p.memory_info().rss for p in [proc, *proc.children(recursive=True)]) / 1024**2  # Memory in MB
+            peak_mem = max(peak_mem, mem)
+            current_duration = time.perf_counter() - start_time
+            if mem > max_mem_mb:
+                kill_tree(proc)
+                status = "memory_limit"
+                break
+            # Add 5 extra secs to account for the imports and array init
+            if current_duration > max_time_sec + 5:
+                kill_tree(proc)
+                status = "time_limit"
+                break
+            time.sleep(poll_interval)
+    except psutil.NoSuchProcess:
+        pass
+
+    stdout, stderr = process.communicate()
+    wall_time = time.perf_counter() - start_time
+
+    result = {"function": function_name, "N": N, "status": status, "wall_s": wall_time, "peak_rss_mb": peak_mem}
+    if status == "ok":
+        if process.returncode == 0:
+            result.update(json.loads(stdout.strip().splitlines()[-1]))
+            result.pop("durations_s", None)
+        else:
+            result["status"] = "error"
+            result["error"] = (stdout + stderr).strip().splitlines()[-1:]
+    return result
+
+
+def verify_complexity(function_name: str, n_values, **limits) -> list:
+    # Increase N until the function hits a limit (or fails), bigger N would only be worse
+    results = []
+    for N in n_values:
+        result = time_algorithm_with_limits(function_name, N, **limits)
+        print(f"{function_name} {N:_}: {result['status']} wall: {result['wall_s']:.3f}s median: {result.get('median_s', float('nan')):.4g}s peak: {result['peak_rss_mb']:.1f}MB")
+        results.append(result)
+        if result["status"] != "ok":
+            break
+    return results
+
+
+def scaling_study(workers_list, N: int, mode: str = "strong", function_name: str = "distributed", **limits) -> list:
+    # strong: the same N for every number of workers, ideal time is t_1 / p
+    # weak: N * sqrt(p / p_1) so every worker computes the same number of interactions, ideal time is t_1
+    # speedup and efficiency are relative to the first (smallest) number of workers
+    results = []
+    reference = None
+    for workers in workers_list:
+        n = N if mode == "strong" else int(round(N * np.sqrt(workers / workers_list[0])))
+        result = time_algorithm_with_limits(function_name, n, extra_args=["--workers", str(workers)], **limits)
+        result.update(mode=mode, workers=workers)
+        if result["status"] == "ok":
+            if reference is None:
+                reference = result
+            ratio = reference["median_s"] / result["median_s"]
+            result["speedup"] = ratio * workers / reference["workers"] if mode == "weak" else ratio
+            result["efficiency"] = result["speedup"] * reference["workers"] / workers
+        print(f"{mode} {function_name} workers {workers} N {n:_}: {result['status']} median: {result.get('median_s', float('nan')):.4g}s "
+              f"speedup: {result.get('speedup', float('nan')):.2f} efficiency: {result.get('efficiency', float('nan')):.2f}")
+        results.append(result)
+    return results
+
+
+def write_scaling(results: list, output_dir: str):
+    with open(os.path.join(output_dir, "scaling.json"), "w") as f:
+        json.dump(results, f, indent=1)
+
+    with open(os.path.join(output_dir, "scaling.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=scaling_columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def plot_scaling(results: list, path: str):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    rows = [r for r in results if r["status"] == "ok"]
+    workers = [r["workers"] for r in rows]
+    figure, (ax_speedup, ax_efficiency) = plt.subplots(1, 2, figsize=(14, 6))
+    ax_speedup.plot(workers, [r["speedup"] for r in rows], marker="o", label="measured")
+    if rows:
+        ax_speedup.plot(workers, [w / workers[0] for w in workers], linestyle="--", label="ideal")
+    ax_speedup.set_xlabel("Workers")
+    ax_speedup.set_ylabel("Speedup")
+    ax_speedup.legend()
+    ax_speedup.grid()
+    ax_efficiency.plot(workers, [r["efficiency"] for r in rows], marker="o")
+    ax_efficiency.set_xlabel("Workers")
+    ax_efficiency.set_ylabel("Parallel efficiency")
+    ax_efficiency.set_ylim(0, 1.1)
+    ax_efficiency.grid()
+    figure.suptitle(f"{rows[0]['mode'].capitalize() if rows else ''} scaling")
+    plt.savefig(path)
+    plt.close()
+
+
+def write_results(results: list, output_dir: str):
+    with open(os.path.join(output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=1)
+
+    with open(os.path.join(output_dir, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=csv_columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def group_by_function(results: list) -> dict:
+    grouped = {}
+    for result in results:
+        grouped.setdefault(result["function"], []).append(result)
+    return grouped
+
+
+def plot_complexity(results: list, path: str):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 10))
+    for function_name, rows in group_by_function(results).items():
+        rows = [r for r in rows if r["status"] == "ok"]
+        plt.plot([r["N"] for r in rows], [r["median_s"] for r in rows], marker="o", label=function_name)
+    plt.xscale("log")
+    plt.yscale("log")
+    plt.xlabel("N")
+    plt.ylabel("Wall-clock time (s)")
+    plt.grid()
+    plt.legend()
+    plt.title("Time Comparison")
+    plt.savefig(path)
+    plt.close()
+
+
+def plot_memory(results: list, path: str):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 10))
+    for function_name, rows in group_by_function(results).items():
+        plt.plot([r["N"] for r in rows], [r["peak_rss_mb"] for r in rows], marker="o", label=function_name)
+    plt.xscale("log")
+    plt.xlabel("N")
+    plt.ylabel("Peak memory usage (MB)")
+    plt.grid()
+    plt.legend()
+    plt.title("Space Comparison (peak RSS)")
+    plt.savefig(path)
+    plt.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling study of the acceleration functions with memory and time limits")
+    parser.add_argument("--functions", nargs="+", default=None, help="Default: every function in acceleration_functions_dic")
+    parser.add_argument("--n-min", type=float, default=1e2)
+    parser.add_argument("--n-max", type=float, default=1e8)
+    parser.add_argument("--steps", type=int, default=13, help="Log spaced values of N between n-min and n-max")
+    parser.add_argument("--max-mem-mb", type=float, default=10 * 1024)
+    parser.add_argument("--max-time", type=float, default=10, help="Seconds per process (+5s for the startup)")
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--output", default="benchmark_results", help="Folder for the csv, json and plots")
+    parser.add_argument("--no-plots", action="store_true")
+    parser.add_argument("--scaling", choices=["strong", "weak"], default=None, help="Scaling study over --workers instead of the sweep over N")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of worker processes of the scaling study")
+    parser.add_argument("--n", type=int, default=20000, help="N of the scaling study (of the first number of workers for weak scaling)")
+    args = parser.parse_args(argv)
+    limits = dict(max_mem_mb=args.max_mem_mb, max_time_sec=args.max_time, repetitions=args.repetitions)
+
+    if args.scaling:
+        os.makedirs(args.output, exist_ok=True)
+        function_name = args.functions[0] if args.functions else "distributed"
+        results = scaling_study(args.workers, args.n, args.scaling, function_name, **limits)
+        write_scaling(results, args.output)
+        if not args.no_plots:
+            plot_scaling(results, os.path.join(args.output, f"{args.scaling}_scaling.png"))
+        return 0
+
+    functions = args.functions
+    if functions is None:
+        # Importing accelerations is cheap, the functions of backends that are not installed are skipped
+        if __package__:
+            from .accelerations import available_functions
+        else:
+            from accelerations import available_functions
+        functions = available_functions()
+
+    n_values = [int(n) for n in np.logspace(np.log10(args.n_min), np.log10(args.n_max), args.steps)]
+
+    os.makedirs(args.output, exist_ok=True)
+    results = []
+    for function_name in functions:
+        results += verify_complexity(function_name, n_values, **limits)
+        # Save after every function so a long sweep can be inspected or interrupted
+        write_results(results, args.output)
+
+    if not args.no_plots:
+        plot_complexity(results, os.path.join(args.output, "time_comparison.png"))
+        plot_memory(results, os.path.join(args.output, "space_comparison.png"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
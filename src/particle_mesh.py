@@ -0,0 +1,153 @@
+# Particle-mesh (PM) solver
+# O(N + G^3 log G) approximation of the N-Body accelerations for large N, with only numpy:
+# * cloud in cell (CIC): every body spreads its mass on the 8 grid nodes around it
+# * the potential of the grid is the convolution of the masses with -1 / r, done with FFTs on a
+#   grid twice as big with the masses in one corner and zeros elsewhere (isolated boundary
+#   conditions, Hockney & Eastwood), so there are no periodic images
+# * accelerations from central differences of the potential, interpolated back to the bodies with
+#   the same CIC weights (no self force and momentum is conserved)
+# Forces are smoothed over about 2 grid cells, fine for collisionless runs, not for close encounters.
+# Follows the conventions of accelerations.py: unit masses, no softening and the same sign of the
+# returned accelerations, masses and softening are optional.
+
+from functools import lru_cache
+
+import numpy as np
+
+
+def grid_geometry(X: np.ndarray, masses: np.ndarray, grid_size: int, box_size: float = None):
+    # (origin, cell size) of a cube with grid_size nodes per side.
+    # Without box_size the cube covers every body, with box_size it is centered on the center of mass
+    # (bodies outside only feel the mesh as a point mass).
+    if box_size is None:
+        low = X.min(axis=0)
+        high = X.max(axis=0)
+        # A bit bigger than the bodies so the last ones don't sit on the edge
+        box_size = max(float(np.max(high - low)), 1e-12) * (1 + 1e-6)
+        center = (low + high) / 2
+    else:
+        center = np.average(X, axis=0, weights=masses)
+    cell_size = box_size / (grid_size - 1)
+    return center - box_size / 2, cell_size
+
+
+def cic_weights(X: np.ndarray, origin: np.ndarray, cell_size: float, grid_size: int):
+    # Lower node and the weight of the upper node on every axis, and the bodies inside the grid
+    u = (X - origin) / cell_size
+    inside = np.all((u >= 0) & (u <= grid_size - 1), axis=1)
+    u = u[inside]
+    lower = np.minimum(np.floor(u).astype(np.int64), grid_size - 2)
+    return lower, u - lower, inside
+
+
+def cic_corners(lower: np.ndarray, fraction: np.ndarray, grid_size: int):
+    # Flat index and weight of the 8 nodes around every body
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                offset = np.array([dx, dy, dz])
+                index = ((lower[:, 0] + dx) * grid_size + lower[:, 1] + dy) * grid_size + lower[:, 2] + dz
+                weight = np.prod(np.where(offset, fraction, 1 - fraction), axis=1)
+                yield index, weight
+
+
+def cic_deposit(lower: np.ndarray, fraction: np.ndarray, masses: np.ndarray, grid_size: int) -> np.ndarray:
+    # Mass on every node (not a density, the Green function below is -1 / r)
+    grid = np.zeros(grid_size**3)
+    for index, weight in cic_corners(lower, fraction, grid_size):
+        grid += np.bincount(index, weights=masses * weight, minlength=grid_size**3)
+    return grid.reshape((grid_size,) * 3)
+
+
+def cic_interpolate(grid: np.ndarray, lower: np.ndarray, fraction: np.ndarray) -> np.ndarray:
+    flat = grid.ravel()
+    result = np.zeros(len(lower))
+    for index, weight in cic_corners(lower, fraction, grid.shape[0]):
+        result += flat[index] * weight
+    return result
+
+
+def green_function(grid_size: int, softening_cells: float, n_padded: int = None) -> np.ndarray:
+    # -1 / r on the padded grid in units of the cell size, distances wrap around so the convolution
+    # of the FFT gives the isolated potential. r = 0 uses half a cell when the softening is smaller.
+    n_padded = 2 * grid_size if n_padded is None else n_padded
+    k = np.arange(n_padded)
+    d = np.minimum(k, n_padded - k).astype(np.float64)
+    r_sqr = d[:, None, None] ** 2 + d[None, :, None] ** 2 + d[None, None, :] ** 2 + softening_cells**2
+    return -1 / np.sqrt(np.maximum(r_sqr, 0.25))
+
+
+@lru_cache(maxsize=4)
+def green_function_fft(grid_size: int, softening_cells: float) -> np.ndarray:
+    # Reused while the cell size doesn't change (fixed box_size or no softening)
+    return np.fft.rfftn(green_function(grid_size, softening_cells))
+
+
+def mesh_potential(mass_grid: np.ndarray, cell_size: float, softening: float) -> np.ndarray:
+    # Potential on the nodes -1 .. grid_size (one ghost node on each side for the gradient)
+    grid_size = mass_grid.shape[0]
+    n_padded = 2 * grid_size
+    kernel = green_function_fft(grid_size, softening / cell_size)
+    shape = (n_padded,) * 3
+    potential = np.fft.irfftn(np.fft.rfftn(mass_grid, s=shape, axes=(0, 1, 2)) * kernel, s=shape, axes=(0, 1, 2)) / cell_size
+    # Node -1 is the last one of the padded grid, inside the zero padding the result is still isolated
+    nodes = np.concatenate(([n_padded - 1], np.arange(grid_size + 1)))
+    return potential[np.ix_(nodes, nodes, nodes)]
+
+
+def self_potential(fraction: np.ndarray, softening_cells: float) -> np.ndarray:
+    # Potential of a unit mass at its own position through the mesh (its cloud seen by its own weights),
+    # per axis the weights of a pair of nodes at distance 0 and 1 are w0^2 + w1^2 and 2 w0 w1
+    kernel = green_function(2, softening_cells)[:2, :2, :2]
+    same = (1 - fraction) ** 2 + fraction**2
+    pairs = np.stack([same, 1 - same], axis=2)
+    return np.einsum("ni,nj,nk,ijk->n", pairs[:, 0], pairs[:, 1], pairs[:, 2], kernel)
+
+
+def particle_mesh_forces(X: np.ndarray, masses: np.ndarray = None, grid_size: int = 64, softening: float = 0.0,
+                         box_size: float = None, potentials: bool = False):
+    # (accelerations, potentials or None), potentials are sum_j -m_j / r without the body itself
+    X = np.asarray(X, dtype=np.float64)
+    masses = np.ones(len(X)) if masses is None else np.asarray(masses, dtype=np.float64)
+    if grid_size < 2:
+        raise ValueError(f"grid_size must be at least 2, got {grid_size}")
+
+    origin, cell_size = grid_geometry(X, masses, grid_size, box_size)
+    lower, fraction, inside = cic_weights(X, origin, cell_size, grid_size)
+    mass_grid = cic_deposit(lower, fraction, masses[inside], grid_size)
+    potential = mesh_potential(mass_grid, cell_size, softening)
+
+    acceleration = np.empty_like(X)
+    center = potential[1:-1, 1:-1, 1:-1]
+    gradients = (
+        (potential[2:, 1:-1, 1:-1] - potential[:-2, 1:-1, 1:-1]),
+        (potential[1:-1, 2:, 1:-1] - potential[1:-1, :-2, 1:-1]),
+        (potential[1:-1, 1:-1, 2:] - potential[1:-1, 1:-1, :-2]),
+    )
+    # a_i = sum_j m_j (x_i - x_j) / r^3 is the gradient of the potential
+    for k, gradient in enumerate(gradients):
+        acceleration[inside, k] = cic_interpolate(gradient, lower, fraction) / (2 * cell_size)
+
+    body_potentials = None
+    if potentials:
+        body_potentials = np.empty(len(X))
+        body_potentials[inside] = (cic_interpolate(center, lower, fraction)
+                                   - masses[inside] * self_potential(fraction, softening / cell_size) / cell_size)
+
+    outside = ~inside
+    if outside.any():
+        # Far from the mesh: point mass at the center of mass of the bodies inside
+        mass = masses[inside].sum()
+        center_of_mass = np.average(X[inside], axis=0, weights=masses[inside]) if mass > 0 else np.zeros(3)
+        diff = X[outside] - center_of_mass
+        distance = np.sqrt(np.sum(diff**2, axis=1) + softening**2)
+        acceleration[outside] = mass * diff / distance[:, None] ** 3
+        if potentials:
+            body_potentials[outside] = -mass / distance
+
+    return acceleration, body_potentials
+
+
+def get_acceleration_particle_mesh(X: np.ndarray, grid_size: int = 64, masses: np.ndarray = None, softening: float = 0.0,
+                                   box_size: float = None) -> np.ndarray:
+    return particle_mesh_forces(X, masses, grid_size, softening, box_size)[0]
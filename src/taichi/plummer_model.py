@@ -1,10 +1,19 @@
+import os
+
 import numpy as np
 
 # Copied from worksheet from Worksheet 7 plummer model notebook.
 # initialise the random number generator
+# Only used when no seed is given, every sample also draws its seed from it
 rng = np.random.Generator(np.random.PCG64(seed=7897))
+
+# generate() works in blocks with their own random stream (spawned from the seed), the same
+# (N, seed) gives the same bodies no matter how many bodies are generated at once.
+BLOCK_SIZE = 1 << 16
+
+
 # Sample isotropic 3d vectors with a given modulus
-def rand_vec3d( mod ):
+def rand_vec3d( mod, rng=rng ):
     N = len(mod)
     phi = 2*np.pi*rng.random(size=N)
     theta = np.arccos( 2*rng.random(size=N)-1 )
@@ -12,24 +21,18 @@ def rand_vec3d( mod ):
     v3d[:,0] = mod * np.cos( phi ) * np.sin( theta )
     v3d[:,1] = mod * np.sin( phi ) * np.sin( theta )
     v3d[:,2] = mod * np.cos( theta )
-    # subtract mean
-    for i in range(3):
-        v3d[:,i] -= np.mean(v3d[:,i])
     return v3d
 
-def sample_plummer(N):
-    # number of stars
-    # N = 1000
-
-    # particle mass is 1/N
-    m = 1/N
-
+def sample_radii(N, rng=rng):
     # Sampling the mass, draw radii through inversion sampling from the cumulative mass M
     U = rng.random(size=N)
-    rsamp = U**(1/3)/np.sqrt((1-U**(2/3)))
+    return U**(1/3)/np.sqrt((1-U**(2/3)))
+
+def sample_plummer(N, rng=rng):
+    rsamp = sample_radii(N, rng)
 
     # create N empty 3D vectors
-    x3d = rand_vec3d( rsamp ).astype(np.float32)
+    x3d = rand_vec3d( rsamp, rng ).astype(np.float32)
     return x3d
 
 # Velocities
@@ -46,24 +49,14 @@ def pq(q):
     return result
 
 
-def sample_q(N):
-    """Use rejection sampling to draw N samples from p_q(q)."""
-    accepted = []
-    max_pq = 512 / (7 * np.pi)  # max value of p(q), used for rejection
-
-    while len(accepted) < N:
-        q_try = np.random.rand(N)  # Uniform q in [0, 1]
-        y_try = np.random.rand(N) * max_pq  # Uniform y in [0, max_pq]
-
-        p_vals = pq(q_try)
-        mask = y_try < p_vals
-        accepted.extend(q_try[mask])
-
-    return np.array(accepted[:N])
+def sample_q(N, rng=rng):
+    """Draw N samples from p_q(q) without rejection."""
+    # With u = q^2, p(u) ~ u^(1/2) (1 - u)^(7/2) is a Beta(3/2, 9/2) distribution
+    return np.sqrt(rng.beta(1.5, 4.5, size=N))
 
 
 # compute velocity vectors as V = q*ve(r)*r
-def sample_velocity_vectors(positions):
+def sample_velocity_vectors(positions, rng=rng):
     """
     Sample velocities for each star given their positions.
     Returns array of shape (N, 3).
@@ -72,30 +65,98 @@ def sample_velocity_vectors(positions):
     radii = np.linalg.norm(positions, axis=1)
     v_esc = escape_velocity(radii)
 
-    q_vals = sample_q(N)
+    q_vals = sample_q(N, rng)
     # actual speed for each star
     speeds = q_vals * v_esc
 
     # Sample random unit directions for each velocity vector
-    phi = 2 * np.pi * np.random.rand(N)
-    cos_theta = 2 * np.random.rand(N) - 1
-    sin_theta = np.sqrt(1 - cos_theta**2)
-
-    vx = speeds * sin_theta * np.cos(phi)
-    vy = speeds * sin_theta * np.sin(phi)
-    vz = speeds * cos_theta
-
-    velocities = np.vstack((vx, vy, vz)).T.astype(np.float32)
+    velocities = rand_vec3d(speeds, rng).astype(np.float32)
     return velocities
 
 
 def correct_center_of_mass(positions, velocities):
     # Subtract the center of mass position and velocity to move to the rest frame of the cluster.
 
-    com = np.mean(positions, axis=0)
-    com_v = np.mean(velocities, axis=0)
+    com = np.mean(positions, axis=0, dtype=np.float64)
+    com_v = np.mean(velocities, axis=0, dtype=np.float64)
 
-    positions_cm = positions - com
-    velocities_cm = velocities - com_v
+    positions_cm = (positions - com).astype(positions.dtype)
+    velocities_cm = (velocities - com_v).astype(velocities.dtype)
     return positions_cm, velocities_cm
 
+
+def new_seed():
+    # Seed of a sample without one, taken from the module generator
+    return int(rng.integers(2**63))
+
+
+def sample_block(seed, block, n):
+    # Bodies [block * BLOCK_SIZE, block * BLOCK_SIZE + n), float32 and not corrected
+    block_rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(block,))))
+    positions = sample_plummer(n, block_rng)
+    return positions, sample_velocity_vectors(positions, block_rng)
+
+
+def generate_chunks(N, seed, chunk_size=BLOCK_SIZE * 16):
+    # Yields (start, positions, velocities) of consecutive chunks, before the center of mass correction
+    chunk_size = max(BLOCK_SIZE, chunk_size // BLOCK_SIZE * BLOCK_SIZE)
+    for start in range(0, N, chunk_size):
+        stop = min(start + chunk_size, N)
+        blocks = [sample_block(seed, b, min(BLOCK_SIZE, stop - b * BLOCK_SIZE)) for b in range(start // BLOCK_SIZE, (stop - 1) // BLOCK_SIZE + 1)]
+        yield start, np.concatenate([p for p, _ in blocks]), np.concatenate([v for _, v in blocks])
+
+
+def generate(N, seed=None):
+    # Positions and velocities (float32, in the center of mass frame) of a Plummer model
+    if seed is None:
+        seed = new_seed()
+    positions = np.empty((N, 3), dtype=np.float32)
+    velocities = np.empty((N, 3), dtype=np.float32)
+    for start, p, v in generate_chunks(N, seed):
+        positions[start:start + len(p)] = p
+        velocities[start:start + len(v)] = v
+    return correct_center_of_mass(positions, velocities)
+
+
+def generate_to_memmap(path_prefix, N, seed, chunk_size=BLOCK_SIZE * 16):
+    # Same bodies as generate(N, seed) written chunk by chunk to <path_prefix>_positions.npy and
+    # <path_prefix>_velocities.npy, only a chunk is in memory (for 10^7 - 10^8 bodies)
+    shape = (N, 3)
+    positions = np.lib.format.open_memmap(path_prefix + "_positions.tmp.npy", mode="w+", dtype=np.float32, shape=shape)
+    velocities = np.lib.format.open_memmap(path_prefix + "_velocities.tmp.npy", mode="w+", dtype=np.float32, shape=shape)
+    sum_positions = np.zeros(3)
+    sum_velocities = np.zeros(3)
+    for start, p, v in generate_chunks(N, seed, chunk_size):
+        positions[start:start + len(p)] = p
+        velocities[start:start + len(v)] = v
+        sum_positions += p.sum(axis=0, dtype=np.float64)
+        sum_velocities += v.sum(axis=0, dtype=np.float64)
+
+    # Second pass for the center of mass correction
+    com = sum_positions / N
+    com_v = sum_velocities / N
+    for start in range(0, N, chunk_size):
+        positions[start:start + chunk_size] = positions[start:start + chunk_size] - com
+        velocities[start:start + chunk_size] = velocities[start:start + chunk_size] - com_v
+    positions.flush()
+    velocities.flush()
+    del positions, velocities
+
+    # Renamed at the end, an interrupted generation never looks like a finished one in the cache
+    os.replace(path_prefix + "_positions.tmp.npy", path_prefix + "_positions.npy")
+    os.replace(path_prefix + "_velocities.tmp.npy", path_prefix + "_velocities.npy")
+    return load_memmap(path_prefix)
+
+
+def load_memmap(path_prefix):
+    return (np.load(path_prefix + "_positions.npy", mmap_mode="r"),
+            np.load(path_prefix + "_velocities.npy", mmap_mode="r"))
+
+
+def cached(N, seed, cache_dir="plummer_cache", chunk_size=BLOCK_SIZE * 16):
+    # Memory-mapped initial conditions of (N, seed), generated the first time
+    os.makedirs(cache_dir, exist_ok=True)
+    path_prefix = os.path.join(cache_dir, f"plummer_{N}_{seed}")
+    if os.path.exists(path_prefix + "_positions.npy") and os.path.exists(path_prefix + "_velocities.npy"):
+        return load_memmap(path_prefix)
+    return generate_to_memmap(path_prefix, N, seed, chunk_size)
@@ -0,0 +1,123 @@
+# Asynchronous frame capture
+# The render loop only copies the framebuffer (window.get_image_buffer_as_numpy()) into a bounded
+# queue, the conversion and encoding happen on worker threads:
+# * a video file (.mp4, .mkv, ...) is piped as raw frames into a local ffmpeg process
+# * anything else is a folder of frame_0000.png written by png_workers threads (also used when ffmpeg is missing)
+# When the queue is full the frame is dropped (or the loop waits with block=True), the counters
+# tell if the capture keeps up.
+
+import os
+import queue
+import shutil
+import threading
+import subprocess
+
+import numpy as np
+
+video_extensions = (".mp4", ".mkv", ".mov", ".avi", ".webm")
+
+
+def to_rgb8(buffer: np.ndarray) -> np.ndarray:
+    # get_image_buffer_as_numpy() is indexed [x, y] from the bottom left with floats in [0, 1]
+    image = buffer.transpose(1, 0, 2)[::-1, :, :3]
+    return np.ascontiguousarray((np.clip(image, 0, 1) * 255).astype(np.uint8))
+
+
+class FrameCapture:
+    def __init__(self, output: str = "output.mp4", fps: int = 30, max_queue: int = 8, png_workers: int = 2,
+                 block: bool = False, ffmpeg_args=("-c:v", "libx264", "-pix_fmt", "yuv420p")):
+        self.output = output
+        self.fps = fps
+        self.block = block
+        self.ffmpeg_args = list(ffmpeg_args)
+        self.use_ffmpeg = output.lower().endswith(video_extensions) and shutil.which("ffmpeg") is not None
+        if output.lower().endswith(video_extensions) and not self.use_ffmpeg:
+            # Same frames, the video can be made later with the ffmpeg command of the readme
+            self.output = os.path.splitext(output)[0] + "_frames"
+            print(f"ffmpeg not found, saving the frames in {self.output}")
+        if not self.use_ffmpeg:
+            os.makedirs(self.output, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.counter_lock = threading.Lock()
+        self.process = None
+        self.error = None
+
+        n_workers = 1 if self.use_ffmpeg else png_workers
+        # ffmpeg needs the frames in order, so only one thread writes to it
+        self.workers = [threading.Thread(target=self.run, daemon=True) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def backlog(self) -> int:
+        return self.queue.qsize()
+
+    def capture(self, window):
+        # Call after canvas.scene(), before window.show()
+        self.capture_buffer(window.get_image_buffer_as_numpy())
+
+    def capture_buffer(self, buffer: np.ndarray):
+        self.captured += 1
+        try:
+            # Numbered without the dropped frames, ffmpeg stops at the first gap of frame_%04d.png
+            self.queue.put((self.captured - self.dropped - 1, buffer), block=self.block)
+        except queue.Full:
+            self.dropped += 1
+
+    def start_ffmpeg(self, height: int, width: int):
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-",
+            *self.ffmpeg_args, self.output,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, index: int, image: np.ndarray):
+        if self.use_ffmpeg:
+            if self.process is None:
+                self.start_ffmpeg(*image.shape[:2])
+            self.process.stdin.write(image.tobytes())
+        else:
+            # matplotlib.image does not need a pyplot backend, safe outside the main thread
+            import matplotlib.image
+            matplotlib.image.imsave(os.path.join(self.output, f"frame_{index:04d}.png"), image)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                index, buffer = item
+                self.write(index, to_rgb8(buffer))
+                with self.counter_lock:
+                    self.written += 1
+            except Exception as e:
+                # Keeps consuming the queue so the render loop never waits on a broken capture
+                self.error = e
+
+    def stats(self) -> str:
+        return f"captured {self.captured}, written {self.written}, dropped {self.dropped}, backlog {self.backlog}"
+
+    def close(self):
+        # Waits for the frames in the queue and for ffmpeg to finish the file
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg already exited, run() has the error of the write that failed
+                pass
+            self.process.wait()
+        if self.error is not None:
+            returncode = f" (ffmpeg exited with {self.process.returncode})" if self.process is not None else ""
+            print(f"Frame capture failed: {self.error}{returncode}")
+        elif self.process is not None and self.process.returncode != 0:
+            print(f"Frame capture failed: ffmpeg exited with {self.process.returncode}")
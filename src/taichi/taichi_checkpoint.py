@@ -0,0 +1,120 @@
+# Checkpoint and restart of taichi_gravity.Simulation
+# One uncompressed .npz per checkpoint: positions and velocities (float32), the accelerations and
+# levels of the block time steps, and a json header with the step, time, parameters and the state of the random generators
+# of plummer_model, so a restarted run continues exactly like the original one.
+# The file is written next to the old one and renamed, a preemption while saving keeps the last good checkpoint.
+
+import os
+import json
+
+import numpy as np
+
+import taichi_gravity
+import plummer_model
+
+# Simulation arguments saved with the state, a restart creates the same Simulation
+parameters = ("dt", "softening", "integrator", "steps_per_call", "force_kernel", "block_dim", "i_block", "max_level", "eta", "track_potential",
+              "pm_grid_size", "pm_box_size", "sort_every")
+# The ones that change the trajectory, a checkpoint is only loaded into a simulation with the same values
+physics_parameters = ("dt", "softening", "integrator", "force_kernel", "max_level", "eta", "pm_grid_size", "pm_box_size")
+
+
+def save_checkpoint(path: str, simulation):
+    header = {
+        "N": simulation.N,
+        "steps": simulation.steps,
+        "time": simulation.time,
+        "pair_interactions": simulation.pair_interactions(),
+        "parameters": {name: getattr(simulation, name) for name in parameters},
+        "plummer_rng": plummer_model.rng.bit_generator.state,
+    }
+    np_random = np.random.get_state()
+    header["np_random"] = [np_random[0], *np_random[2:]]
+
+    arrays = dict(
+        positions=simulation.positions.to_numpy(),
+        velocities=simulation.velocities.to_numpy(),
+        # Original index of every star, the Morton sort moves them around
+        ids=simulation.ids.to_numpy(),
+        np_random_keys=np_random[1],
+        header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+    )
+    if simulation.integrator == "block":
+        # Recomputing them on restart would pick new levels (and round differently)
+        arrays["levels"] = simulation.levels.to_numpy()
+        arrays["accelerations"] = simulation.accelerations.to_numpy()
+
+    # np.savez adds .npz to names without it
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path: str):
+    # (header, arrays) without touching taichi
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    header = json.loads(arrays.pop("header").tobytes().decode())
+    return header, arrays
+
+
+def check_compatible(header: dict, simulation):
+    # Raises ValueError if the simulation can't continue the saved run (restore_simulation creates one that can)
+    if simulation.N != header["N"]:
+        raise ValueError(f"Checkpoint has N = {header['N']}, the simulation N = {simulation.N}")
+    saved = header["parameters"]
+    different = [f"{name} {saved[name]} != {getattr(simulation, name)}" for name in physics_parameters
+                 if name in saved and saved[name] != getattr(simulation, name)]
+    if different:
+        raise ValueError(f"Checkpoint of a different simulation: {', '.join(different)}")
+
+
+def load_checkpoint(path: str, simulation):
+    # Restores the state into an existing Simulation with the same N and physics, returns the header
+    header, arrays = read_checkpoint(path)
+    check_compatible(header, simulation)
+    simulation.positions.from_numpy(arrays["positions"])
+    simulation.velocities.from_numpy(arrays["velocities"])
+    if "ids" in arrays:
+        simulation.ids.from_numpy(arrays["ids"])
+        simulation.reordered = not np.array_equal(arrays["ids"], np.arange(header["N"]))
+    else:
+        simulation.reset_ids()
+    simulation.accelerations_valid = False
+    simulation.potentials_valid = False
+    simulation.steps = header["steps"]
+    simulation.time = header["time"]
+    # pair_interactions() continues from the saved count (the device counter of the block steps is kept)
+    simulation.direct_interactions += header["pair_interactions"] - simulation.pair_interactions()
+
+    if "levels" in arrays and simulation.integrator == "block":
+        simulation.levels.from_numpy(arrays["levels"])
+        simulation.accelerations.from_numpy(arrays["accelerations"])
+        simulation.accelerations_valid = True
+
+    plummer_model.rng.bit_generator.state = header["plummer_rng"]
+    state = header["np_random"]
+    np.random.set_state((state[0], arrays["np_random_keys"], *state[1:]))
+    return header
+
+
+def restore_simulation(path: str, arch=None, **overrides):
+    # New Simulation with the saved parameters (overrides replace some of them) and state
+    header, _ = read_checkpoint(path)
+    kwargs = dict(header["parameters"], **overrides)
+    simulation = taichi_gravity.Simulation(N=header["N"], arch=arch, **kwargs)
+    load_checkpoint(path, simulation)
+    return simulation
+
+
+class Checkpointer:
+    def __init__(self, path: str, every: int, start_step: int = 0):
+        self.path = path
+        self.every = every
+        self.last_step = start_step
+
+    def after_step(self, simulation):
+        # Saves when the simulation went over a multiple of every steps since the last call
+        if simulation.steps // self.every > self.last_step // self.every:
+            save_checkpoint(self.path, simulation)
+        self.last_step = simulation.steps
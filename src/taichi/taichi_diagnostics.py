@@ -0,0 +1,151 @@
+# Conservation diagnostics of taichi_gravity.Simulation computed on the device
+# Every `every` calls of simulation.step() one sample (energies, momentum, center of mass and
+# Lagrangian radii) is written into a ring buffer of fields, nothing is copied to the host
+# until history() or latest() is called.
+# Units follow taichi_gravity: G = 1 and every star has mass 1 / N.
+
+import numpy as np
+import taichi as ti
+
+
+@ti.data_oriented
+class Diagnostics:
+    def __init__(self, simulation, every: int = 10, capacity: int = 1024, mass_fractions=(0.1, 0.5, 0.9),
+                 n_bins: int = 512, r_min: float = 1e-3, r_max: float = 1e3):
+        self.simulation = simulation
+        self.every = every
+        self.capacity = capacity
+        self.mass_fractions = tuple(mass_fractions)
+        # Lagrangian radii come from a histogram with log spaced bins between r_min and r_max,
+        # the resolution is a factor (r_max / r_min)^(1 / n_bins) (2.7% with the defaults)
+        self.n_bins = n_bins
+        self.r_min = r_min
+        self.r_max = r_max
+
+        self.time = ti.field(dtype=ti.f32, shape=capacity)
+        self.kinetic = ti.field(dtype=ti.f32, shape=capacity)
+        self.potential = ti.field(dtype=ti.f32, shape=capacity)
+        self.momentum = ti.Vector.field(3, dtype=ti.f32, shape=capacity)
+        self.center_of_mass = ti.Vector.field(3, dtype=ti.f32, shape=capacity)
+        self.lagrangian_radii = ti.field(dtype=ti.f32, shape=(capacity, len(self.mass_fractions)))
+        self.fractions = ti.field(dtype=ti.f32, shape=len(self.mass_fractions))
+        self.fractions.from_numpy(np.array(self.mass_fractions, dtype=np.float32))
+        self.histogram = ti.field(dtype=ti.i32, shape=n_bins)
+        # Energy of the first sample, the drift is measured from it
+        self.initial_energy = ti.field(dtype=ti.f32, shape=())
+        self.reset()
+
+    def reset(self):
+        # Forget the samples, e.g. after new initial conditions
+        self.calls = 0
+        self.n_samples = 0
+        self.cached = None
+
+    @ti.func
+    def pair_potential(self, positions: ti.template(), i, softening):
+        # Same softening as the force kernels, only used when the force pass did not store it
+        N = positions.shape[0]
+        potential = 0.0
+        for j in range(N):
+            if i != j:
+                potential -= ti.rsqrt((positions[i] - positions[j]).norm_sqr() + softening)
+        return potential / N
+
+    @ti.kernel
+    def sample_kernel(self, positions: ti.template(), velocities: ti.template(), potentials: ti.template(), slot: ti.i32, time: ti.f32,
+                      first: ti.i32, softening: ti.f32, fused: ti.template()):
+        N = positions.shape[0]
+        mass = 1.0 / N
+        self.time[slot] = time
+        self.kinetic[slot] = 0.0
+        self.potential[slot] = 0.0
+        self.momentum[slot] = ti.Vector([0.0, 0.0, 0.0])
+        self.center_of_mass[slot] = ti.Vector([0.0, 0.0, 0.0])
+        for b in self.histogram:
+            self.histogram[b] = 0
+
+        for i in positions:
+            v = velocities[i]
+            self.kinetic[slot] += 0.5 * mass * v.norm_sqr()
+            self.momentum[slot] += mass * v
+            self.center_of_mass[slot] += mass * positions[i]
+            # Every pair is counted twice
+            if ti.static(fused):
+                self.potential[slot] += 0.5 * mass * potentials[i]
+            else:
+                self.potential[slot] += 0.5 * mass * self.pair_potential(positions, i, softening)
+
+        # Radial histogram around the center of mass
+        log_r_min = ti.log(self.r_min)
+        bins_per_log = self.n_bins / (ti.log(self.r_max) - log_r_min)
+        for i in positions:
+            r = (positions[i] - self.center_of_mass[slot]).norm()
+            b = ti.cast(ti.floor((ti.log(ti.max(r, self.r_min)) - log_r_min) * bins_per_log), ti.i32)
+            ti.atomic_add(self.histogram[ti.min(b, self.n_bins - 1)], 1)
+
+        # Serial scan of the (small) histogram, interpolated inside the bin
+        ti.loop_config(serialize=True)
+        for f in range(self.fractions.shape[0]):
+            target = self.fractions[f] * N
+            cumulative = 0.0
+            radius = self.r_max
+            found = False
+            for b in range(self.n_bins):
+                if not found:
+                    count = ti.cast(self.histogram[b], ti.f32)
+                    if cumulative + count >= target:
+                        frac = (target - cumulative) / ti.max(count, 1.0)
+                        radius = ti.exp(log_r_min + (b + frac) / bins_per_log)
+                        found = True
+                    cumulative += count
+            self.lagrangian_radii[slot, f] = radius
+
+        if first:
+            self.initial_energy[None] = self.kinetic[slot] + self.potential[slot]
+
+    def sample(self):
+        simulation = self.simulation
+        if simulation.force_kernel == "pm" and not simulation.potentials_valid:
+            # The direct sum differs from the mesh potential by a few %, mixing both would count it as drift
+            simulation.mesh_potentials()
+        # Only valid when the stored potentials match the positions
+        fused = simulation.potentials_valid
+        self.sample_kernel(simulation.positions, simulation.velocities, simulation.potentials, self.n_samples % self.capacity,
+                           simulation.time, self.n_samples == 0, simulation.softening, fused)
+        self.n_samples += 1
+        self.cached = None
+
+    def after_step(self):
+        # Call after every simulation.step(), samples every `every` calls
+        if self.calls % self.every == 0:
+            self.sample()
+        self.calls += 1
+
+    def history(self) -> dict:
+        # Samples still in the ring buffer, oldest first (copies to the host)
+        if self.cached is not None:
+            return self.cached
+        n = min(self.n_samples, self.capacity)
+        order = (np.arange(n) + self.n_samples - n) % self.capacity
+        kinetic = self.kinetic.to_numpy()[order].astype(np.float64)
+        potential = self.potential.to_numpy()[order].astype(np.float64)
+        self.cached = {
+            "time": self.time.to_numpy()[order],
+            "kinetic": kinetic,
+            "potential": potential,
+            "energy": kinetic + potential,
+            "momentum": self.momentum.to_numpy()[order],
+            "center_of_mass": self.center_of_mass.to_numpy()[order],
+            "lagrangian_radii": self.lagrangian_radii.to_numpy()[order],
+        }
+        self.cached_initial_energy = float(self.initial_energy[None])
+        return self.cached
+
+    def latest(self) -> dict:
+        # Last sample plus the relative energy drift since the first one
+        history = self.history()
+        if len(history["time"]) == 0:
+            return None
+        sample = {key: values[-1] for key, values in history.items()}
+        sample["energy_drift"] = (sample["energy"] - self.cached_initial_energy) / abs(self.cached_initial_energy)
+        return sample
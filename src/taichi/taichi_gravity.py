@@ -1,37 +1,64 @@
-import taichi as ti
-import plummer_model 
+import os
+import sys
+import math
 
-ti.init(arch=ti.gpu)
-# ti.init(arch=ti.gpu, debug=True)
+import numpy as np
+import taichi as ti
+import plummer_model
 
-# # Config
+# # Default config
 N = int(4e4)  # Change this number as needed
 # N = int(2e3)  # Change this number as needed
 dt = 1e-1
 # dt = 0.01
 softening = 1e-3
 
-# Fields
-# positions = ti.Vector.field(3, dtype=ti.f32, shape=N)
-# velocities = ti.Vector.field(3, dtype=ti.f32, shape=N)
-positions = ti.Vector.field(3, dtype=ti.f32)
-velocities = ti.Vector.field(3, dtype=ti.f32)
 
 
-def create_fields():
-    # Shared root that can be accessed in other modules
-    node = ti.root.dense(ti.i, N)
-    node.place(positions, velocities)
-    return node  # <- return the root so others can use it
+def load_accelerations_taichi():
+    # accelerations_taichi.py lives next to accelerations.py, one folder up
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if src_dir not in sys.path:
+        sys.path.append(src_dir)
+    import accelerations_taichi
+    return accelerations_taichi
+
+
+def init(arch=ti.gpu, **kwargs):
+    # ti.init resets taichi, every field created before is lost (also the ones of accelerations.py with the taichi backend),
+    # the guard of accelerations_taichi checks the runtime of the process so only the first call initializes
+    load_accelerations_taichi().init(arch, **kwargs)
+    # ti.init(arch=ti.gpu, debug=True)
+
 
+# Counter based random numbers for the on-device Plummer sampler: every star hashes (seed, i)
+# into its own PCG state, so a seed gives the same bodies whatever the number of threads.
+@ti.func
+def pcg_hash(x):
+    state = x * ti.u32(747796405) + ti.u32(2891336453)
+    word = ((state >> ((state >> ti.u32(28)) + ti.u32(4))) ^ state) * ti.u32(277803737)
+    return (word >> ti.u32(22)) ^ word
 
-def init_bodies_plummer():
-    R = plummer_model.sample_plummer(N)
-    V = plummer_model.sample_velocity_vectors(R)
-    R, V = plummer_model.correct_center_of_mass(R, V)
-    positions.from_numpy(R)
-    velocities.from_numpy(V)
 
+@ti.func
+def next_uniform(state):
+    # Returns the new state and a float in [0, 1) with 24 random bits
+    state = pcg_hash(state)
+    return state, ti.cast(state >> ti.u32(8), ti.f32) * (1.0 / 16777216.0)
+
+
+@ti.func
+def random_direction(state):
+    state, u = next_uniform(state)
+    state, w = next_uniform(state)
+    phi = 2 * math.pi * u
+    cos_theta = 2 * w - 1
+    sin_theta = ti.sqrt(ti.max(1 - cos_theta * cos_theta, 0.0))
+    return state, ti.Vector([sin_theta * ti.cos(phi), sin_theta * ti.sin(phi), cos_theta])
+
+
+# Maximum of plummer_model.pq (at q^2 = 2/9), bound of the rejection sampling (acceptance ~47%)
+max_pq = 512 / (7 * math.pi) * (2 / 9) * (7 / 9) ** 3.5
 
 
 # @ti.kernel
@@ -58,10 +85,236 @@ def init_bodies_plummer():
 #         velocities[i] += force * dt
 
 
-@ti.kernel
-def update_velocities(dt: ti.f32):
-    for i in range(N):
+# The simulation owns its fields so several can exist in one process and N can change
+# without restarting python. The kernels receive the fields as templates, so they are
+# compiled once per set of fields and rebuilding for a new N compiles them again.
+#
+# Integrators:
+# "dkd": drift(dt/2), kick(dt), drift(dt/2), three kernel launches per step.
+# "kdk": kick(dt/2) + drift(dt) fused in one loop, then the force loop also does the
+#        closing kick(dt/2). The accelerations are kept for the next step so there is one force
+#        evaluation per step, and steps_per_call steps are launched as a single kernel. The steps are
+#        unrolled (only the outermost loops of a kernel run in parallel, a loop over the steps around
+#        them would make them serial) so the kernel and its compile time grow with steps_per_call,
+#        at most max_steps_per_call.
+# "block": hierarchical power of two block time steps, every star has a level l with step dt / 2^l
+#          (l <= max_level) chosen from its acceleration and jerk. Every call advances dt and only the
+#          stars that end their step at a substep get their forces computed.
+integrators = ("dkd", "kdk", "block")
+max_steps_per_call = 16
+
+# Force kernels:
+# "direct": every thread streams all the positions from global memory.
+# "tiled": on gpu blocks of positions are loaded into block shared memory and reused by every
+#          thread of the block. On cpu every thread computes i_block bodies at once, so every
+#          position loaded is used i_block times. Both use rsqrt and an unrolled inner loop.
+# "pm": particle mesh of src/particle_mesh.py on the host (numpy FFT), O(N + G^3 log G) instead of
+#       O(N^2) with the forces smoothed over the cells of a pm_grid_size^3 grid of side pm_box_size.
+#       Collisionless runs only, the positions and accelerations are copied every step (dkd and kdk).
+force_kernels = ("direct", "tiled", "pm")
+
+
+def load_particle_mesh():
+    # particle_mesh.py lives next to accelerations.py, one folder up
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if src_dir not in sys.path:
+        sys.path.append(src_dir)
+    import particle_mesh
+    return particle_mesh
+
+
+@ti.data_oriented
+class Simulation:
+    def __init__(self, N: int = N, dt: float = dt, softening: float = softening, arch=None, integrator: str = "dkd", steps_per_call: int = 1,
+                 force_kernel: str = "direct", block_dim: int = 128, i_block: int = 4, max_level: int = 6, eta: float = 0.02,
+                 track_potential: bool = False, pm_grid_size: int = 64, pm_box_size: float = 20.0, sort_every: int = 0):
+        # Without arch the simulation uses the arch taichi is already on (gpu the first time)
+        if arch is not None or load_accelerations_taichi().current_arch() is None:
+            init(arch if arch is not None else ti.gpu)
+        if integrator not in integrators:
+            raise ValueError(f"{integrator} not in integrators: {integrators}")
+        if force_kernel not in force_kernels:
+            raise ValueError(f"{force_kernel} not in force kernels: {force_kernels}")
+        if not 1 <= steps_per_call <= max_steps_per_call:
+            raise ValueError(f"steps_per_call must be between 1 and {max_steps_per_call}, got {steps_per_call}")
+        if force_kernel == "pm" and integrator == "block":
+            raise ValueError("The block integrator needs the jerks of the direct force kernel")
+        if force_kernel == "tiled" and softening <= 0:
+            # The tiled kernels don't skip i == j, the softening makes that term 0 instead of 0 / 0
+            raise ValueError(f"The tiled force kernel needs softening > 0, got {softening}")
+
+        self.force_kernel = force_kernel
+        # Shared memory only exists on the gpu backends
+        self.use_shared_memory = ti.lang.impl.current_cfg().arch not in (ti.x64, ti.arm64)
+        # Threads per block (gpu) and bodies per thread (cpu) of the tiled kernel
+        self.block_dim = block_dim
+        self.i_block = i_block
+
+        # Block time steps: finest step is dt / 2^max_level, eta is the accuracy of the step criterion
+        self.max_level = max_level
+        self.eta = eta
+
+        # The force kernels also store the softened potential of every star (for the energy diagnostics),
+        # fixed at construction since it changes the compiled kernels
+        self.track_potential = track_potential
+
+        # Particle mesh: nodes per side and side of the box around the center of mass, 20 holds
+        # 98.5% of the mass of the Plummer model (scale radius 1), the stars outside feel a point mass
+        self.pm_grid_size = pm_grid_size
+        self.pm_box_size = pm_box_size
+        self.particle_mesh = load_particle_mesh() if force_kernel == "pm" else None
+
+        # Sort the stars along a Morton curve every sort_every steps (0 never), see sort_morton
+        self.sort_every = sort_every
+
+        self.dt = dt
+        self.softening = softening
+        self.integrator = integrator
+        # Only for kdk, every different value compiles the kernel again
+        self.steps_per_call = steps_per_call
+        self.snode_tree = None
+        # Other per star fields permuted with the stars (e.g. the colors of taichi_render), see attach_field
+        self.scratch_trees = []
+        self.attached_scratch = {}
+        self.build(N)
+
+    def build(self, N: int):
+        # (Re)allocate the fields for N bodies, the old ones are freed
+        self.destroy()
+        self.N = N
+        self.positions = ti.Vector.field(3, dtype=ti.f32)
+        self.velocities = ti.Vector.field(3, dtype=ti.f32)
+        self.accelerations = ti.Vector.field(3, dtype=ti.f32)
+        self.potentials = ti.field(dtype=ti.f32)
+        # Block time steps
+        self.jerks = ti.Vector.field(3, dtype=ti.f32)
+        self.levels = ti.field(dtype=ti.i32)
+        self.active_ids = ti.field(dtype=ti.i32)
+        self.active_count = ti.field(dtype=ti.i32)
+        self.active_total = ti.field(dtype=ti.i64)
+        # Reductions of the on-device Plummer sampler
+        self.center_of_mass = ti.Vector.field(3, dtype=ti.f32)
+        self.center_of_mass_velocity = ti.Vector.field(3, dtype=ti.f32)
+        # Morton sort: original index of the star in every slot, keys, permutation, bounding box
+        # and scratch fields for the gather
+        self.ids = ti.field(dtype=ti.i32)
+        self.morton_keys = ti.field(dtype=ti.u64)
+        self.sort_order = ti.field(dtype=ti.i32)
+        self.lower = ti.Vector.field(3, dtype=ti.f32)
+        self.upper = ti.Vector.field(3, dtype=ti.f32)
+        self.scratch_vectors = ti.Vector.field(3, dtype=ti.f32)
+        self.scratch_floats = ti.field(dtype=ti.f32)
+        self.scratch_ints = ti.field(dtype=ti.i32)
+
+        fb = ti.FieldsBuilder()
+        fb.dense(ti.i, N).place(self.positions, self.velocities, self.accelerations)
+        fb.dense(ti.i, N).place(self.potentials)
+        fb.dense(ti.i, N).place(self.jerks, self.levels, self.active_ids)
+        fb.dense(ti.i, N).place(self.ids, self.morton_keys, self.sort_order)
+        fb.dense(ti.i, N).place(self.scratch_vectors, self.scratch_floats, self.scratch_ints)
+        fb.place(self.active_count, self.active_total, self.center_of_mass, self.center_of_mass_velocity, self.lower, self.upper)
+        self.snode_tree = fb.finalize()
+        # Attached fields are for the old N
+        self.attached_fields = []
+        self.reset_ids()
+        self.accelerations_valid = False
+        # potentials match the positions (only after kdk and block steps with track_potential and mesh_potentials)
+        self.potentials_valid = False
+        self.steps = 0
+        self.time = 0.0
+        # Pair interactions of the dkd and kdk steps, the block ones are counted on the device
+        self.direct_interactions = 0
+
+    def destroy(self):
+        if self.snode_tree is not None:
+            self.snode_tree.destroy()
+            self.snode_tree = None
+        for tree in self.scratch_trees:
+            tree.destroy()
+        self.scratch_trees = []
+        self.attached_scratch = {}
+
+    def init_bodies_plummer(self, seed: int = None, cache_dir: str = None):
+        # The same seed gives the same bodies, without one every call is a new sample.
+        # With cache_dir and a seed the sample is kept on disk (memory-mapped) and reused for the same (N, seed),
+        # without a seed it could never be read again so it isn't cached
+        if cache_dir is not None and seed is not None:
+            R, V = plummer_model.cached(self.N, seed, cache_dir)
+        else:
+            R, V = plummer_model.generate(self.N, seed)
+        self.positions.from_numpy(R)
+        self.velocities.from_numpy(V)
+        self.reset_state()
+
+    def reset_state(self):
+        self.accelerations_valid = False
+        self.potentials_valid = False
+        self.steps = 0
+        self.time = 0.0
+        # New bodies, the slot is the id again
+        self.reset_ids()
+
+    @ti.kernel
+    def fill_ids(self, ids: ti.template()):
+        for i in ids:
+            ids[i] = i
+
+    def reset_ids(self):
+        self.fill_ids(self.ids)
+        # False while ids is the identity, the outputs can skip to_original_order
+        self.reordered = False
+
+    @ti.kernel
+    def sample_plummer(self, positions: ti.template(), velocities: ti.template(), center_of_mass: ti.template(),
+                       center_of_mass_velocity: ti.template(), seed: ti.u32):
+        # Same distribution as plummer_model.generate but one star per thread, q by rejection
+        N = positions.shape[0]
+        center_of_mass[None] = ti.Vector([0.0, 0.0, 0.0])
+        center_of_mass_velocity[None] = ti.Vector([0.0, 0.0, 0.0])
+        for i in positions:
+            state = pcg_hash(ti.cast(i, ti.u32) ^ pcg_hash(seed))
+            state, u = next_uniform(state)
+            u_third = u ** (1 / 3)
+            # u = 1 - 2^-24 rounds u_third to 1 in f32 (r = inf), clamped to the smallest difference that
+            # can happen otherwise: 1 - (1 - 2^-24)^2 = 2^-23, r < 2900
+            r = u_third / ti.sqrt(ti.max(1 - u_third * u_third, 1.0 / 8388608.0))
+            state, direction = random_direction(state)
+            x = r * direction
+
+            q = 0.0
+            while True:
+                state, q_try = next_uniform(state)
+                state, y = next_uniform(state)
+                q_sqr = q_try * q_try
+                if y * max_pq < 512 / (7 * math.pi) * q_sqr * (1 - q_sqr) ** 3.5:
+                    q = q_try
+                    break
+            v_esc = ti.sqrt(2 / ti.sqrt(1 + r * r))
+            state, direction = random_direction(state)
+            v = q * v_esc * direction
+
+            positions[i] = x
+            velocities[i] = v
+            center_of_mass[None] += x / N
+            center_of_mass_velocity[None] += v / N
+
+        for i in positions:
+            positions[i] -= center_of_mass[None]
+            velocities[i] -= center_of_mass_velocity[None]
+
+    def init_bodies_plummer_device(self, seed: int = None):
+        # Samples the Plummer model in a kernel, no transfer from the host (different bodies than
+        # init_bodies_plummer for the same seed)
+        if seed is None:
+            seed = plummer_model.new_seed()
+        self.sample_plummer(self.positions, self.velocities, self.center_of_mass, self.center_of_mass_velocity, seed & 0xFFFFFFFF)
+        self.reset_state()
+
+    @ti.func
+    def acceleration(self, positions: ti.template(), i, softening):
+        N = positions.shape[0]
         force = ti.Vector([0.0, 0.0, 0.0])
+        potential = 0.0
         for j in range(N):
             if i != j:
                 r = positions[i] - positions[j]
@@ -75,21 +328,391 @@ def update_velocities(dt: ti.f32):
                 # dist = ti.rsqrt(normsqrt)
 
                 force -= r / (dist**3)
-        velocities[i] += (force/N) * dt
+                if ti.static(self.track_potential):
+                    potential -= 1 / dist
+        return force / N, potential / N
+
+    @ti.func
+    def force_kick_tiled_shared(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), potentials: ti.template(), dt_kick, softening):
+        N = positions.shape[0]
+        block_dim = ti.static(self.block_dim)
+        n_tiles = (N + block_dim - 1) // block_dim
+
+        ti.loop_config(block_dim=block_dim)
+        for i in range(n_tiles * block_dim):
+            tid = i % block_dim
+            tile = ti.simt.block.SharedArray((block_dim,), ti.math.vec3)
+            xi = positions[ti.min(i, N - 1)]
+            force = ti.Vector([0.0, 0.0, 0.0])
+            potential = 0.0
+
+            for t in range(n_tiles):
+                # Every thread of the block loads one position of the tile
+                tile[tid] = positions[ti.min(t * block_dim + tid, N - 1)]
+                ti.simt.block.sync()
+
+                for k in ti.static(range(block_dim)):
+                    # Same condition for the whole block, no divergence
+                    if t * block_dim + k < N:
+                        r = xi - tile[k]
+                        inv_dist = ti.rsqrt(r.norm_sqr() + softening)
+                        # i == j has r = 0 and adds nothing as long as softening > 0
+                        force -= r * (inv_dist * inv_dist * inv_dist)
+                        if ti.static(self.track_potential):
+                            potential -= inv_dist
+                ti.simt.block.sync()
+
+            if i < N:
+                a = force / N
+                accelerations[i] = a
+                velocities[i] += a * dt_kick
+                if ti.static(self.track_potential):
+                    # Removes the i == j term
+                    potentials[i] = (potential + ti.rsqrt(softening)) / N
+
+    @ti.func
+    def force_kick_tiled_blocked(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), potentials: ti.template(), dt_kick, softening):
+        N = positions.shape[0]
+        i_block = ti.static(self.i_block)
+
+        for b in range((N + i_block - 1) // i_block):
+            xi = ti.Matrix.zero(ti.f32, i_block, 3)
+            force = ti.Matrix.zero(ti.f32, i_block, 3)
+            potential = ti.Vector.zero(ti.f32, i_block)
+            for k in ti.static(range(i_block)):
+                p = positions[ti.min(b * i_block + k, N - 1)]
+                for c in ti.static(range(3)):
+                    xi[k, c] = p[c]
+
+            for j in range(N):
+                pj = positions[j]
+                # Unrolled over the bodies of the block, every pj is reused i_block times
+                for k in ti.static(range(i_block)):
+                    r = ti.Vector([xi[k, 0] - pj[0], xi[k, 1] - pj[1], xi[k, 2] - pj[2]])
+                    inv_dist = ti.rsqrt(r.norm_sqr() + softening)
+                    # i == j has r = 0 and adds nothing as long as softening > 0
+                    inv_cube = inv_dist * inv_dist * inv_dist
+                    for c in ti.static(range(3)):
+                        force[k, c] -= r[c] * inv_cube
+                    if ti.static(self.track_potential):
+                        potential[k] -= inv_dist
+
+            for k in ti.static(range(i_block)):
+                i = b * i_block + k
+                if i < N:
+                    a = ti.Vector([force[k, 0], force[k, 1], force[k, 2]]) / N
+                    accelerations[i] = a
+                    velocities[i] += a * dt_kick
+                    if ti.static(self.track_potential):
+                        potentials[i] = (potential[k] + ti.rsqrt(softening)) / N
+
+    @ti.func
+    def force_kick(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), potentials: ti.template(), dt_kick, softening):
+        # Computes and stores the accelerations and adds them to the velocities with dt_kick
+        if ti.static(self.force_kernel == "tiled" and self.use_shared_memory):
+            self.force_kick_tiled_shared(positions, velocities, accelerations, potentials, dt_kick, softening)
+        elif ti.static(self.force_kernel == "tiled"):
+            self.force_kick_tiled_blocked(positions, velocities, accelerations, potentials, dt_kick, softening)
+        else:
+            for i in positions:
+                a, potential = self.acceleration(positions, i, softening)
+                accelerations[i] = a
+                velocities[i] += a * dt_kick
+                if ti.static(self.track_potential):
+                    potentials[i] = potential
+
+    @ti.kernel
+    def update_velocities(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), potentials: ti.template(), dt: ti.f32, softening: ti.f32):
+        self.force_kick(positions, velocities, accelerations, potentials, dt, softening)
+
+    @ti.kernel
+    def compute_accelerations(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), potentials: ti.template(), softening: ti.f32):
+        self.force_kick(positions, velocities, accelerations, potentials, 0.0, softening)
+
+    @ti.kernel
+    def kdk_steps(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), potentials: ti.template(), dt: ti.f32, softening: ti.f32, n_steps: ti.template()):
+        # The static loop is unrolled, every loop inside is still a parallel loop
+        # and taichi runs them in order inside the same launch.
+        for _ in ti.static(range(n_steps)):
+            for i in positions:
+                velocities[i] += accelerations[i] * (dt / 2)
+                positions[i] += velocities[i] * dt
+            self.force_kick(positions, velocities, accelerations, potentials, dt / 2, softening)
+
+    @ti.func
+    def acceleration_jerk(self, positions: ti.template(), velocities: ti.template(), i, softening):
+        # Same softened force as acceleration() plus its time derivative (jerk)
+        N = positions.shape[0]
+        acc = ti.Vector([0.0, 0.0, 0.0])
+        jerk = ti.Vector([0.0, 0.0, 0.0])
+        potential = 0.0
+        for j in range(N):
+            if i != j:
+                r = positions[i] - positions[j]
+                v = velocities[i] - velocities[j]
+                inv_dist_sqr = 1.0 / (r.norm_sqr() + softening)
+                inv_dist_cube = inv_dist_sqr * ti.sqrt(inv_dist_sqr)
+                acc -= r * inv_dist_cube
+                jerk -= (v - 3 * r.dot(v) * inv_dist_sqr * r) * inv_dist_cube
+                if ti.static(self.track_potential):
+                    potential -= ti.sqrt(inv_dist_sqr)
+        return acc / N, jerk / N, potential / N
+
+    @ti.func
+    def desired_level(self, a, jerk, dt_max, eta, max_level: ti.template()):
+        # Simple Aarseth-like criterion dt = eta |a| / |jerk| rounded down to a power of two of dt_max
+        dt_i = eta * a.norm() / ti.max(jerk.norm(), 1e-30)
+        level = ti.cast(ti.ceil(ti.log(dt_max / dt_i) / ti.log(2.0)), ti.i32)
+        return ti.min(ti.max(level, 0), max_level)
+
+    @ti.kernel
+    def block_init(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), jerks: ti.template(), levels: ti.template(),
+                   potentials: ti.template(), dt_max: ti.f32, softening: ti.f32, eta: ti.f32, max_level: ti.template()):
+        for i in positions:
+            a, jerk, potential = self.acceleration_jerk(positions, velocities, i, softening)
+            accelerations[i] = a
+            potentials[i] = potential
+            jerks[i] = jerk
+            levels[i] = self.desired_level(a, jerk, dt_max, eta, max_level)
+
+    @ti.kernel
+    def block_kick_drift(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), levels: ti.template(),
+                         substep: ti.i32, dt_min: ti.f32, max_level: ti.template()):
+        for i in positions:
+            period = 1 << (max_level - levels[i])
+            # Opening half kick of the stars starting their step
+            if substep % period == 0:
+                velocities[i] += accelerations[i] * (dt_min * period / 2)
+            positions[i] += velocities[i] * dt_min
+
+    @ti.kernel
+    def block_force_kick(self, positions: ti.template(), velocities: ti.template(), accelerations: ti.template(), jerks: ti.template(), levels: ti.template(),
+                         potentials: ti.template(), active_ids: ti.template(), active_count: ti.template(), active_total: ti.template(),
+                         substep_end: ti.i32, dt_min: ti.f32, softening: ti.f32, eta: ti.f32, max_level: ti.template()):
+        # List of the stars ending their step, the force loop only runs over them
+        active_count[None] = 0
+        for i in positions:
+            if substep_end % (1 << (max_level - levels[i])) == 0:
+                active_ids[ti.atomic_add(active_count[None], 1)] = i
+        active_total[None] += active_count[None]
+
+        for k in range(active_count[None]):
+            i = active_ids[k]
+            a, jerk, potential = self.acceleration_jerk(positions, velocities, i, softening)
+            accelerations[i] = a
+            jerks[i] = jerk
+            # Only up to date for every star at the end of the block step, where all are active
+            potentials[i] = potential
+            level = levels[i]
+            period = 1 << (max_level - level)
+            # Closing half kick
+            velocities[i] += a * (dt_min * period / 2)
+
+            # Smaller steps are always possible, a bigger one only when the time is
+            # in sync with it and one level at a time
+            new_level = self.desired_level(a, jerk, dt_min * (1 << max_level), eta, max_level)
+            if new_level < level:
+                new_level = level
+                if level > 0 and substep_end % (period * 2) == 0:
+                    new_level = level - 1
+            levels[i] = new_level
+
+    def block_step(self):
+        n_substeps = 1 << self.max_level
+        dt_min = self.dt / n_substeps
+        fields = (self.positions, self.velocities, self.accelerations, self.jerks, self.levels, self.potentials)
+        if not self.accelerations_valid:
+            self.block_init(*fields, self.dt, self.softening, self.eta, self.max_level)
+            self.accelerations_valid = True
+
+        for substep in range(n_substeps):
+            self.block_kick_drift(self.positions, self.velocities, self.accelerations, self.levels, substep, dt_min, self.max_level)
+            self.block_force_kick(*fields, self.active_ids, self.active_count, self.active_total,
+                                  substep + 1, dt_min, self.softening, self.eta, self.max_level)
+
+    # Morton (Z-order) sort: the stars are reordered so the ones close in space are close in memory,
+    # neighbouring threads of the force kernels then read nearby positions and the tiles of the tiled
+    # kernel hold stars of the same region. 21 bits per axis in the bounding box (63 bit keys),
+    # the keys are sorted on the device with ti.algorithms.parallel_sort.
+    @ti.func
+    def spread_bits(self, v):
+        # 21 bits of v to every third bit of a u64
+        x = ti.cast(v, ti.u64) & ti.u64(0x1FFFFF)
+        x = (x | (x << 32)) & ti.u64(0x1F00000000FFFF)
+        x = (x | (x << 16)) & ti.u64(0x1F0000FF0000FF)
+        x = (x | (x << 8)) & ti.u64(0x100F00F00F00F00F)
+        x = (x | (x << 4)) & ti.u64(0x10C30C30C30C30C3)
+        x = (x | (x << 2)) & ti.u64(0x1249249249249249)
+        return x
+
+    @ti.kernel
+    def compute_morton_keys(self, positions: ti.template(), keys: ti.template(), order: ti.template(),
+                            lower: ti.template(), upper: ti.template()):
+        lower[None] = ti.Vector([math.inf, math.inf, math.inf])
+        upper[None] = ti.Vector([-math.inf, -math.inf, -math.inf])
+        for i in positions:
+            for k in ti.static(range(3)):
+                ti.atomic_min(lower[None][k], positions[i][k])
+                ti.atomic_max(upper[None][k], positions[i][k])
+
+        for i in positions:
+            extent = ti.max(upper[None] - lower[None], 1e-30)
+            cell = ti.math.clamp((positions[i] - lower[None]) / extent * 2097151.0, 0.0, 2097151.0)
+            keys[i] = self.spread_bits(ti.cast(cell[0], ti.u32)) | (self.spread_bits(ti.cast(cell[1], ti.u32)) << 1) \
+                | (self.spread_bits(ti.cast(cell[2], ti.u32)) << 2)
+            order[i] = i
+
+    @ti.kernel
+    def permute(self, field: ti.template(), scratch: ti.template(), order: ti.template()):
+        # field[i] = field[order[i]], through the scratch field (the loops run one after the other)
+        for i in order:
+            scratch[i] = field[order[i]]
+        for i in order:
+            field[i] = scratch[i]
+
+    def attach_field(self, field):
+        # Per star field (shape N) kept in the order of the stars by sort_morton, e.g. colors
+        if field.shape != (self.N,):
+            raise ValueError(f"Attached fields need shape ({self.N},), got {field.shape}")
+        self.attached_fields.append(field)
+
+    def scratch_for(self, field):
+        # Scratch field with the element type of an attached field, allocated on first use
+        key = id(field)
+        if key not in self.attached_scratch:
+            if isinstance(field, ti.MatrixField):
+                scratch = ti.Vector.field(field.n, dtype=field.dtype)
+            else:
+                scratch = ti.field(dtype=field.dtype)
+            fb = ti.FieldsBuilder()
+            fb.dense(ti.i, self.N).place(scratch)
+            self.scratch_trees.append(fb.finalize())
+            self.attached_scratch[key] = scratch
+        return self.attached_scratch[key]
+
+    def sort_morton(self):
+        # Reorders every per star field (and the attached ones) by the Morton key of the positions,
+        # ids keeps the original index so the outputs can go back to it (to_original_order)
+        self.compute_morton_keys(self.positions, self.morton_keys, self.sort_order, self.lower, self.upper)
+        ti.algorithms.parallel_sort(self.morton_keys, self.sort_order)
+
+        # accelerations, potentials and levels move with their star, the integrator state stays valid
+        for field in (self.positions, self.velocities, self.accelerations, self.jerks):
+            self.permute(field, self.scratch_vectors, self.sort_order)
+        self.permute(self.potentials, self.scratch_floats, self.sort_order)
+        self.permute(self.levels, self.scratch_ints, self.sort_order)
+        self.permute(self.ids, self.scratch_ints, self.sort_order)
+        for field in self.attached_fields:
+            self.permute(field, self.scratch_for(field), self.sort_order)
+        self.reordered = True
+
+    def to_original_order(self, array: np.ndarray) -> np.ndarray:
+        # Per star array of the current order (e.g. positions.to_numpy()) in the order of the ids
+        if not self.reordered:
+            return array
+        result = np.empty_like(array)
+        result[self.ids.to_numpy()] = array
+        return result
+
+    def pair_interactions(self) -> int:
+        # Forces computed since the fields were built, reads the device counter of the block steps
+        return self.direct_interactions + int(self.active_total[None]) * self.N
+
+    def advance_clock(self, n_steps: int):
+        self.steps += n_steps
+        self.time += n_steps * self.dt
+        # Between steps, the block steps never stop in the middle of a substep
+        if self.sort_every > 0 and self.steps // self.sort_every > (self.steps - n_steps) // self.sort_every:
+            self.sort_morton()
+
+    @ti.kernel
+    def update_positions(self, positions: ti.template(), velocities: ti.template(), dt: ti.f32):
+        for i in positions:
+            positions[i] += velocities[i] * dt
+
+    @ti.kernel
+    def kick(self, velocities: ti.template(), accelerations: ti.template(), dt: ti.f32):
+        for i in velocities:
+            velocities[i] += accelerations[i] * dt
+
+    def run_particle_mesh(self, potentials: bool):
+        # (accelerations, potentials or None) of the particle mesh, computed in float64 on the host
+        softening_length = math.sqrt(self.softening)  # softening is added to r^2 in the direct kernels
+        masses = np.full(self.N, 1 / self.N)
+        return self.particle_mesh.particle_mesh_forces(
+            self.positions.to_numpy(), masses, self.pm_grid_size, softening_length, self.pm_box_size, potentials
+        )
+
+    def mesh_forces(self):
+        # No pair interactions are counted, the rates of pm are only steps/s
+        a, potentials = self.run_particle_mesh(self.track_potential)
+        # particle_mesh has the sign of accelerations.py, the opposite of the force here
+        self.accelerations.from_numpy((-a).astype(np.float32))
+        if self.track_potential:
+            self.potentials.from_numpy(potentials.astype(np.float32))
+
+    def mesh_potentials(self):
+        # Potentials of the mesh at the current positions (e.g. for the diagnostics between dkd steps),
+        # the energy is then measured with the same forces the stars feel
+        _, potentials = self.run_particle_mesh(True)
+        self.potentials.from_numpy(potentials.astype(np.float32))
+        self.potentials_valid = True
+
+    def mesh_step(self):
+        if self.integrator == "kdk":
+            if not self.accelerations_valid:
+                self.mesh_forces()
+                self.accelerations_valid = True
+            for _ in range(self.steps_per_call):
+                self.kick(self.velocities, self.accelerations, self.dt / 2)
+                self.update_positions(self.positions, self.velocities, self.dt)
+                self.mesh_forces()
+                self.kick(self.velocities, self.accelerations, self.dt / 2)
+            self.advance_clock(self.steps_per_call)
+            self.potentials_valid = self.track_potential
+            return
+
+        self.update_positions(self.positions, self.velocities, self.dt / 2)
+        self.mesh_forces()
+        self.kick(self.velocities, self.accelerations, self.dt)
+        self.update_positions(self.positions, self.velocities, self.dt / 2)
+        self.accelerations_valid = False
+        self.potentials_valid = False
+        self.advance_clock(1)
 
+    def step(self):
+        # Advances 1 step with dkd and block (dt in substeps) and steps_per_call steps with kdk
+        if self.force_kernel == "pm":
+            self.mesh_step()
+            return
 
-@ti.kernel
-def update_positions(dt: ti.f32):
-    for i in range(N):
-        positions[i] += velocities[i] * dt
+        if self.integrator == "block":
+            self.block_step()
+            self.advance_clock(1)
+            # The last substep updates every star
+            self.potentials_valid = self.track_potential
+            return
 
+        if self.integrator == "kdk":
+            if not self.accelerations_valid:
+                self.compute_accelerations(self.positions, self.velocities, self.accelerations, self.potentials, self.softening)
+                self.direct_interactions += self.N * self.N
+                self.accelerations_valid = True
+            self.kdk_steps(self.positions, self.velocities, self.accelerations, self.potentials, self.dt, self.softening, self.steps_per_call)
+            self.direct_interactions += self.steps_per_call * self.N * self.N
+            self.advance_clock(self.steps_per_call)
+            self.potentials_valid = self.track_potential
+            return
 
-def step():
-    update_positions(dt / 2)
-    update_velocities(dt)
-    update_positions(dt / 2)
+        self.update_positions(self.positions, self.velocities, self.dt / 2)
+        self.update_velocities(self.positions, self.velocities, self.accelerations, self.potentials, self.dt, self.softening)
+        self.update_positions(self.positions, self.velocities, self.dt / 2)
+        self.direct_interactions += self.N * self.N
+        self.accelerations_valid = False
+        # The forces were computed half a step ago
+        self.potentials_valid = False
+        self.advance_clock(1)
 
-    # update_velocities(dt/2)
-    # update_positions(dt)
-    # update_velocities(dt/2)
-    
+        # update_velocities(dt/2)
+        # update_positions(dt)
+        # update_velocities(dt/2)
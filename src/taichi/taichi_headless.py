@@ -0,0 +1,182 @@
+# Headless simulation driver
+# Steps taichi_gravity without the window of taichi_render, for batch nodes without GPU or display:
+#   python taichi_headless.py --n 40000 --steps 1000 --arch cpu --render-every 100
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import taichi as ti
+
+import taichi_gravity
+import taichi_diagnostics
+import taichi_snapshots
+import taichi_checkpoint
+
+archs = {
+    "cpu": ti.cpu,
+    "gpu": ti.gpu,
+    "cuda": ti.cuda,
+    "vulkan": ti.vulkan,
+    "metal": ti.metal,
+    "opengl": ti.opengl,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the N-Body simulation without rendering")
+    parser.add_argument("--n", type=int, default=taichi_gravity.N, help="Number of stars")
+    parser.add_argument("--dt", type=float, default=taichi_gravity.dt)
+    parser.add_argument("--softening", type=float, default=taichi_gravity.softening)
+    parser.add_argument("--steps", type=int, default=100, help="Total steps, a resumed run only does the remaining ones")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the Plummer model (default: a new one every run)")
+    parser.add_argument("--device-init", action="store_true", help="Sample the Plummer model on the device (ignores --plummer-cache)")
+    parser.add_argument("--plummer-cache", default=None, help="Folder to keep the initial conditions of (N, seed) between runs (only with --seed)")
+    parser.add_argument("--arch", choices=list(archs), default="gpu")
+    parser.add_argument("--integrator", choices=taichi_gravity.integrators, default="dkd")
+    parser.add_argument("--steps-per-call", type=int, default=1, help=f"Steps launched together with the kdk integrator (at most {taichi_gravity.max_steps_per_call})")
+    parser.add_argument("--force-kernel", choices=taichi_gravity.force_kernels, default="direct")
+    parser.add_argument("--pm-grid-size", type=int, default=64, help="Force kernel pm: grid nodes per side")
+    parser.add_argument("--pm-box-size", type=float, default=20.0, help="Force kernel pm: side of the grid around the center of mass")
+    parser.add_argument("--sort-every", type=int, default=0, help="Sort the stars in Morton order every k steps for memory locality (0 to disable)")
+    parser.add_argument("--max-level", type=int, default=6, help="Block integrator: smallest step is dt / 2^max-level")
+    parser.add_argument("--eta", type=float, default=0.02, help="Block integrator: accuracy of the time step criterion")
+    parser.add_argument("--render-every", type=int, default=0, help="Save a density image every k steps (0 to disable)")
+    parser.add_argument("--frames-dir", default="frames")
+    parser.add_argument("--report-every", type=int, default=0, help="Print the rates every k steps (0 only at the end)")
+    parser.add_argument("--snapshot-every", type=int, default=0, help="Append positions and velocities to --snapshot-dir every k steps (0 to disable)")
+    parser.add_argument("--snapshot-dir", default="snapshots")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file, the run resumes from it if it exists")
+    parser.add_argument("--checkpoint-every", type=int, default=0, help="Save the checkpoint every k steps (0 only at the end)")
+    parser.add_argument("--diagnostics-every", type=int, default=0, help="Sample energy, momentum and Lagrangian radii every k calls (0 to disable)")
+    return parser.parse_args(argv)
+
+
+def render_density(positions: np.ndarray, path: str, extent: float = 10, resolution: int = 800):
+    # Projection on the x-y plane, cheap enough to not slow down the simulation
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    density, _, _ = np.histogram2d(
+        positions[:, 1], positions[:, 0], bins=resolution, range=[[-extent, extent], [-extent, extent]]
+    )
+    plt.imsave(path, np.log1p(density), cmap="inferno", origin="lower")
+
+
+def report(step: int, timed_steps: int, interactions: int, elapsed: float):
+    # interactions counts the forces actually computed, less than N^2 per step with the block integrator
+    # and None for the particle mesh (no pairs)
+    rates = f"{timed_steps / elapsed:.2f} steps/s"
+    if interactions is not None:
+        rates += f", {interactions / elapsed:.3e} interactions/s"
+    print(f"step {step}: {rates}")
+
+
+def crossed(step: int, steps_per_call: int, every: int) -> bool:
+    # True if the last call went over a multiple of every (0 disables it)
+    return every > 0 and step // every > (step - steps_per_call) // every
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        # Same N and parameters as the saved run, the ones of the command line are ignored
+        simulation = taichi_checkpoint.restore_simulation(args.checkpoint, arch=archs[args.arch], track_potential=args.diagnostics_every > 0)
+        print(f"Resumed from {args.checkpoint} at step {simulation.steps} (time {simulation.time:.3f})")
+    else:
+        simulation = taichi_gravity.Simulation(
+            N=args.n, dt=args.dt, softening=args.softening, arch=archs[args.arch],
+            integrator=args.integrator, steps_per_call=args.steps_per_call, force_kernel=args.force_kernel,
+            max_level=args.max_level, eta=args.eta, track_potential=args.diagnostics_every > 0,
+            pm_grid_size=args.pm_grid_size, pm_box_size=args.pm_box_size, sort_every=args.sort_every,
+        )
+        if args.device_init:
+            simulation.init_bodies_plummer_device(args.seed)
+        else:
+            simulation.init_bodies_plummer(args.seed, args.plummer_cache)
+    start_step = simulation.steps
+    if start_step >= args.steps:
+        print(f"Already at step {start_step}, nothing to do")
+        return 0
+
+    checkpointer = None
+    if args.checkpoint and args.checkpoint_every:
+        checkpointer = taichi_checkpoint.Checkpointer(args.checkpoint, args.checkpoint_every, start_step)
+    diagnostics = None
+    if args.diagnostics_every:
+        diagnostics = taichi_diagnostics.Diagnostics(simulation, every=args.diagnostics_every)
+        diagnostics.sample()
+    # Steps advanced by every call to simulation.step()
+    steps_per_call = simulation.steps_per_call if simulation.integrator == "kdk" else 1
+
+    if args.render_every:
+        os.makedirs(args.frames_dir, exist_ok=True)
+    snapshots = None
+    if args.snapshot_every:
+        snapshots = taichi_snapshots.SnapshotWriter(
+            args.snapshot_dir, simulation.N, metadata=dict(dt=simulation.dt, softening=simulation.softening, integrator=simulation.integrator),
+            resume_step=start_step if start_step else None,
+        )
+        if not start_step:
+            snapshots.write_simulation(simulation)
+
+    def after_call():
+        # Outputs of the steps of the last call, the same for the first (untimed) call and the others
+        step = simulation.steps
+        if diagnostics is not None:
+            diagnostics.after_step()
+        if checkpointer is not None:
+            checkpointer.after_step(simulation)
+        if crossed(step, steps_per_call, args.render_every):
+            render_density(simulation.positions.to_numpy(), os.path.join(args.frames_dir, f"frame_{step:06d}.png"))
+        if crossed(step, steps_per_call, args.snapshot_every):
+            snapshots.write_simulation(simulation)
+
+    # First call compiles the kernels, not included in the rates
+    start_time = time.perf_counter()
+    simulation.step()
+    ti.sync()
+    print(f"First step (with compile): {time.perf_counter() - start_time:.3f}s")
+    after_call()
+
+    timed_start_step = simulation.steps
+    start_interactions = simulation.pair_interactions()
+
+    def timed_interactions():
+        # The particle mesh has no pair interactions, only steps/s are reported
+        if simulation.force_kernel == "pm":
+            return None
+        return simulation.pair_interactions() - start_interactions
+
+    start_time = time.perf_counter()
+    while simulation.steps < args.steps:
+        simulation.step()
+        step = simulation.steps
+        after_call()
+        if crossed(step, steps_per_call, args.report_every):
+            ti.sync()
+            report(step, step - timed_start_step, timed_interactions(), time.perf_counter() - start_time)
+
+    step = simulation.steps
+    ti.sync()
+    if args.checkpoint:
+        taichi_checkpoint.save_checkpoint(args.checkpoint, simulation)
+    if snapshots is not None:
+        snapshots.close()
+        print(f"{snapshots.n_frames} snapshots in {args.snapshot_dir}")
+    if not crossed(step, steps_per_call, args.report_every):
+        report(step, step - timed_start_step, timed_interactions(), time.perf_counter() - start_time)
+    if diagnostics is not None:
+        diagnostics.sample()
+        sample = diagnostics.latest()
+        print(f"time {sample['time']:.3f}: energy {sample['energy']:.6f}, drift {sample['energy_drift']:.2e}, |P| {np.linalg.norm(sample['momentum']):.2e}, "
+              f"Lagrangian radii {np.round(sample['lagrangian_radii'].astype(float), 3).tolist()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,25 @@
+import os
+import threading
+import numpy as np
 import taichi as ti
 import taichi_gravity
+import taichi_diagnostics
+import taichi_checkpoint
+import taichi_capture
 
-ti.init(arch=ti.gpu)
 # ti.init(arch=ti.gpu, debug=True)
-N = taichi_gravity.N
+# Add sort_every=100 to sort the stars in Morton order every 100 steps (the colors are attached below and move with them)
+simulation = taichi_gravity.Simulation(N=taichi_gravity.N, arch=ti.gpu)
+N = simulation.N
+diagnostics = taichi_diagnostics.Diagnostics(simulation, every=10)
+# "c" saves the simulation here and "r" goes back to it (a new Plummer model if there is no checkpoint yet or it is of another simulation)
+checkpoint_path = "checkpoint.npz"
 
+positions = simulation.positions
+velocities = simulation.velocities
 
-shared_node = taichi_gravity.create_fields()
 
-positions = taichi_gravity.positions
-velocities = taichi_gravity.velocities
-
-
-colors = ti.Vector.field(4, dtype=ti.f32)
-shared_node.place(colors)
+colors = ti.Vector.field(4, dtype=ti.f32, shape=N)
 
 
 @ti.kernel
@@ -100,6 +106,8 @@ def rotate_vec_up(v: ti.Vector, angle: ti.f32) -> ti.Vector:
 
 
 init_colors()
+# Every star keeps its color when they are sorted
+simulation.attach_field(colors)
 
 
 # Initialize GUI
@@ -128,7 +136,9 @@ rotation_speed = 0.001
 
 rotate_y = False
 rotate_x = 0
-record = False
+# Frame capture, "v" starts recording into a new video and "b" stops it
+capture = None
+recordings = 0
 
 
 # Axes
@@ -153,7 +163,8 @@ axes_colors[3] = [0,1,0]
 axes_colors[4] = [1,0,0]
 axes_colors[5] = [1,0,0]
 
-taichi_gravity.init_bodies_plummer()
+# Sampled on the device, no copy from the host
+simulation.init_bodies_plummer_device()
 i = 0
 while window.running:
     # Handle events
@@ -163,6 +174,9 @@ while window.running:
             paused = not paused
         elif e.key == "r":
             reset_requested = True
+        elif e.key == "c":
+            taichi_checkpoint.save_checkpoint(checkpoint_path, simulation)
+            print(f"Saved {checkpoint_path} at step {simulation.steps}")
         elif e.key == "z":
             camera_pos = camera_pos + zoom_sensitivity
             zoomed = True
@@ -171,21 +185,37 @@ while window.running:
             zoomed = True
         elif e.key == "p":
             rotate_y = not rotate_y
-        elif e.key == "v":
-            record = True
+        elif e.key == "v" and capture is None:
+            capture = taichi_capture.FrameCapture(f"recording_{recordings:02d}.mp4")
+            recordings += 1
         elif e.key == "l":
             rotate_x = 1 if not rotate_x else 0
         elif e.key == "k":
             rotate_x = -1 if not rotate_x else 0
-        elif e.key == "b":
-            record = False
+        elif e.key == "b" and capture is not None:
+            # Finishes the file without stopping the window
+            threading.Thread(target=capture.close).start()
+            capture = None
 
     if zoomed:
         camera.position(*camera_pos)
         print(camera.curr_position)
 
     if reset_requested:
-        taichi_gravity.init_bodies_plummer()
+        restored = False
+        if os.path.exists(checkpoint_path):
+            # Colors by id, the saved stars may be in another order
+            colors_by_id = simulation.to_original_order(colors.to_numpy())
+            try:
+                taichi_checkpoint.load_checkpoint(checkpoint_path, simulation)
+                colors.from_numpy(colors_by_id[simulation.ids.to_numpy()])
+                restored = True
+            except ValueError as e:
+                # Saved by another run (other N, dt, ...), the fields of the window stay as they are
+                print(f"Not restoring {checkpoint_path}: {e}")
+        if not restored:
+            simulation.init_bodies_plummer_device()
+        diagnostics.reset()
         camera.position(0, 0, starting_z)
         camera.lookat(0, 0, 0)
         reset_requested = False
@@ -209,7 +239,8 @@ while window.running:
 
     # Update physics
     if not paused:
-        taichi_gravity.step()
+        simulation.step()
+        diagnostics.after_step()
 
     # Render
     scene.set_camera(camera)
@@ -233,9 +264,29 @@ while window.running:
         gui.text(f"Status: {'Paused' if paused else 'Running'}")
         if gui.button("Reset"):
             reset_requested = True
+        if capture is not None:
+            gui.text(f"Recording: {capture.written} written")
+            gui.text(f"Dropped: {capture.dropped} backlog: {capture.backlog}")
+
+    # Only copies from the device when there is a new sample
+    sample = diagnostics.latest()
+    if sample is not None:
+        with gui.sub_window("Diagnostics", 0.05, 0.3, 0.15, 0.25):
+            gui.text(f"Time: {sample['time']:.2f}")
+            gui.text(f"Energy: {sample['energy']:.6f}")
+            gui.text(f"Energy drift: {sample['energy_drift']:.2e}")
+            gui.text(f"Virial ratio: {-2 * sample['kinetic'] / sample['potential']:.3f}")
+            gui.text(f"|P|: {np.linalg.norm(sample['momentum']):.2e}")
+            gui.text("COM: ({:.2e}, {:.2e}, {:.2e})".format(*sample["center_of_mass"]))
+            for fraction, radius in zip(diagnostics.mass_fractions, sample["lagrangian_radii"]):
+                gui.text(f"r{fraction * 100:.0f}%: {radius:.3f}")
 
     canvas.scene(scene)
+    # Paused frames would only repeat the same picture in the video
+    if capture is not None and not paused:
+        capture.capture(window)
     window.show()
-    if record:
-        window.save_image(f"frames/frame_{i:04d}.png")
     i = i + 1
+
+if capture is not None:
+    capture.close()
@@ -0,0 +1,191 @@
+# Replay viewer
+# Renders the frames saved by taichi_snapshots (taichi_headless.py --snapshot-every k) instead of
+# running the physics, so the frame rate only depends on the rendering:
+#   python taichi_replay.py snapshots --speed 0.5 --decimate 10
+# Controls: space pause, left / right one frame back / forward, up / down playback speed,
+# the Replay panel has a slider to jump to any frame.
+
+import sys
+import threading
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import taichi as ti
+
+import taichi_snapshots
+import taichi_capture
+
+archs = {
+    "cpu": ti.cpu,
+    "gpu": ti.gpu,
+    "cuda": ti.cuda,
+    "vulkan": ti.vulkan,
+    "metal": ti.metal,
+    "opengl": ti.opengl,
+}
+
+
+class FramePrefetcher:
+    # Loads the next frames from the memory-mapped snapshots on a background thread,
+    # the render loop only copies an array that is already in memory.
+    def __init__(self, reader, decimate: int = 1, depth: int = 4):
+        self.reader = reader
+        self.decimate = decimate
+        self.depth = depth
+        self.frames = OrderedDict()
+        self.requested = []
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load(self, i: int) -> np.ndarray:
+        # Copy out of the memmap, only every decimate-th star
+        return np.ascontiguousarray(self.reader.positions(i)[::self.decimate])
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.requested:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                i = self.requested.pop(0)
+                if i in self.frames:
+                    continue
+            frame = self.load(i)
+            with self.condition:
+                self.store(i, frame)
+
+    def store(self, i: int, frame: np.ndarray):
+        # Called with the condition held. Keeps the frames around the current one
+        self.frames[i] = frame
+        self.frames.move_to_end(i)
+        while len(self.frames) > 2 * self.depth + 1:
+            self.frames.popitem(last=False)
+
+    def get(self, i: int, direction: int = 1) -> np.ndarray:
+        with self.condition:
+            frame = self.frames.get(i)
+            if frame is not None:
+                self.frames.move_to_end(i)
+            self.requested = [
+                j for j in (i + direction * k for k in range(1, self.depth + 1))
+                if 0 <= j < len(self.reader) and j not in self.frames
+            ]
+            self.condition.notify()
+        if frame is None:
+            # Jumped somewhere not prefetched (scrubbing)
+            frame = self.load(i)
+            with self.condition:
+                self.store(i, frame)
+        return frame
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay saved snapshots of the N-Body simulation")
+    parser.add_argument("snapshot_dir", nargs="?", default="snapshots")
+    parser.add_argument("--arch", choices=list(archs), default="gpu")
+    parser.add_argument("--speed", type=float, default=1.0, help="Snapshots advanced per rendered frame")
+    parser.add_argument("--decimate", type=int, default=1, help="Only show every k-th star")
+    parser.add_argument("--radius", type=float, default=0.05)
+    parser.add_argument("--loop", action="store_true", help="Start again after the last frame")
+    parser.add_argument("--record", default=None, help="Video file (or folder of png) with every frame shown while playing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    ti.init(arch=archs[args.arch])
+
+    reader = taichi_snapshots.SnapshotReader(args.snapshot_dir)
+    if len(reader) == 0:
+        print(f"No snapshots in {args.snapshot_dir}")
+        return 1
+    n_shown = len(range(0, reader.N, args.decimate))
+    prefetcher = FramePrefetcher(reader, args.decimate)
+
+    positions = ti.Vector.field(3, dtype=ti.f32, shape=n_shown)
+    colors = ti.Vector.field(4, dtype=ti.f32, shape=n_shown)
+    colors.from_numpy(np.concatenate([np.random.rand(n_shown, 3), np.full((n_shown, 1), 0.6)], axis=1).astype(np.float32))
+
+    window = ti.ui.Window("N-Body Replay", (1920, 800))
+    canvas = window.get_canvas()
+    scene = ti.ui.Scene()
+    camera = ti.ui.Camera()
+    gui = window.get_gui()
+    camera.position(0, 0, 60)
+    camera.lookat(0, 0, 0)
+
+    # The replay can wait for the encoder, so no frame is dropped
+    capture = taichi_capture.FrameCapture(args.record, block=True) if args.record else None
+    paused = False
+    speed = args.speed
+    # Fractional position so speeds below 1 show every frame several times
+    playhead = 0.0
+    shown_frame = -1
+    while window.running:
+        direction = 1 if speed >= 0 else -1
+        for e in window.get_events(ti.ui.PRESS):
+            if e.key == ti.ui.SPACE:
+                paused = not paused
+            elif e.key == ti.ui.RIGHT:
+                playhead = min(int(playhead) + 1, len(reader) - 1)
+            elif e.key == ti.ui.LEFT:
+                playhead = max(int(playhead) - 1, 0)
+                direction = -1
+            elif e.key == ti.ui.UP:
+                speed *= 2
+            elif e.key == ti.ui.DOWN:
+                speed /= 2
+
+        if not paused:
+            playhead += speed
+            if playhead >= len(reader) or playhead < 0:
+                # The run may still be writing, look for new frames before stopping or looping
+                reader.refresh()
+                if playhead >= len(reader):
+                    playhead = 0.0 if args.loop else len(reader) - 1
+                    paused = paused or not args.loop
+                playhead = max(playhead, 0.0)
+
+        frame = int(playhead)
+        if frame != shown_frame:
+            positions.from_numpy(prefetcher.get(frame, direction))
+            shown_frame = frame
+
+        scene.set_camera(camera)
+        camera.track_user_inputs(window, hold_key=ti.ui.SHIFT)
+        scene.ambient_light((0.9, 0.9, 0.9))
+        scene.particles(positions, radius=args.radius, per_vertex_color=colors)
+
+        with gui.sub_window("Replay", 0.05, 0.05, 0.2, 0.2):
+            gui.text(f"Bodies: {n_shown:_} of {reader.N:_}")
+            gui.text(f"Step: {reader.steps[frame]}  time: {reader.times[frame]:.3f}")
+            gui.text(f"Status: {'Paused' if paused else 'Playing'}")
+            new_frame = gui.slider_int("Frame", frame, 0, len(reader) - 1)
+            if new_frame != frame:
+                playhead = float(new_frame)
+            speed = gui.slider_float("Speed", speed, -8.0, 8.0)
+
+        canvas.scene(scene)
+        if capture is not None and not paused:
+            capture.capture(window)
+        window.show()
+
+    prefetcher.close()
+    if capture is not None:
+        capture.close()
+        print(f"{args.record}: {capture.stats()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# Streaming snapshot output
+# Positions and velocities (float32) are appended every k steps to a folder of preallocated .npy chunks:
+#   snapshots/index.json                  N, frames written, step and time of every frame
+#   snapshots/positions_00000.npy         (frames_per_chunk, N, 3) memory-mapped
+#   snapshots/velocities_00000.npy
+# The disk writes run on a background thread, the simulation only waits for the copy from the device.
+# SnapshotReader memory-maps the chunks lazily, reading a frame only touches that frame on disk.
+
+import os
+import json
+import queue
+import threading
+
+import numpy as np
+
+
+def chunk_path(path: str, name: str, chunk: int) -> str:
+    return os.path.join(path, f"{name}_{chunk:05d}.npy")
+
+
+class SnapshotWriter:
+    def __init__(self, path: str, N: int, every: int = 10, frames_per_chunk: int = 64, max_queue: int = 4, metadata: dict = None,
+                 resume_step: int = None):
+        self.path = path
+        self.N = N
+        self.every = every
+        self.frames_per_chunk = frames_per_chunk
+        self.metadata = metadata or {}
+        os.makedirs(path, exist_ok=True)
+
+        self.n_frames = 0
+        self.steps = []
+        self.times = []
+        self.calls = 0
+        self.chunk = None
+        self.chunk_arrays = None
+        if resume_step is not None and os.path.exists(os.path.join(path, "index.json")):
+            self.resume(resume_step)
+        # Bounded so a slow disk blocks the simulation instead of filling the memory
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def resume(self, step: int):
+        # Keeps the frames up to step (e.g. of a restarted checkpoint), the later ones are overwritten
+        with open(os.path.join(self.path, "index.json")) as f:
+            index = json.load(f)
+        if index["N"] != self.N or index["frames_per_chunk"] != self.frames_per_chunk:
+            raise ValueError(f"Snapshots in {self.path} have a different N or frames_per_chunk")
+        self.steps = [s for s in index["steps"] if s <= step]
+        self.times = index["times"][:len(self.steps)]
+        self.n_frames = len(self.steps)
+
+    def open_chunk(self, chunk: int):
+        shape = (self.frames_per_chunk, self.N, 3)
+        self.chunk = chunk
+        self.chunk_arrays = []
+        for name in ("positions", "velocities"):
+            path = chunk_path(self.path, name, chunk)
+            # Chunks of a resumed run already exist and keep their first frames
+            mode = "r+" if self.n_frames % self.frames_per_chunk and os.path.exists(path) else "w+"
+            self.chunk_arrays.append(np.lib.format.open_memmap(path, mode=mode, dtype=np.float32, shape=shape))
+
+    def write_index(self):
+        index = dict(self.metadata, N=self.N, frames_per_chunk=self.frames_per_chunk, n_frames=self.n_frames,
+                     steps=self.steps, times=self.times)
+        # Replaced at once, a reader never sees a half written index
+        tmp_path = os.path.join(self.path, "index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, "index.json"))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                step, time, positions, velocities = item
+                chunk, offset = divmod(self.n_frames, self.frames_per_chunk)
+                if chunk != self.chunk:
+                    if self.chunk_arrays is not None:
+                        for array in self.chunk_arrays:
+                            array.flush()
+                    self.open_chunk(chunk)
+                self.chunk_arrays[0][offset] = positions
+                self.chunk_arrays[1][offset] = velocities
+                for array in self.chunk_arrays:
+                    array.flush()
+                self.n_frames += 1
+                self.steps.append(int(step))
+                self.times.append(float(time))
+                self.write_index()
+            except Exception as e:
+                # Raised again in the main thread by the next write or close
+                self.error = e
+            self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"Snapshot writer failed: {self.error}") from self.error
+
+    def write(self, positions: np.ndarray, velocities: np.ndarray, step: int, time: float):
+        # The arrays are owned by the writer after this call (to_numpy() already returns copies)
+        self.check_error()
+        self.queue.put((step, time, np.asarray(positions, dtype=np.float32), np.asarray(velocities, dtype=np.float32)))
+
+    def write_simulation(self, simulation):
+        # Frames keep the original order of the stars, also when the simulation sorts them
+        self.write(simulation.to_original_order(simulation.positions.to_numpy()),
+                   simulation.to_original_order(simulation.velocities.to_numpy()), simulation.steps, simulation.time)
+
+    def after_step(self, simulation):
+        # Call after every simulation.step(), writes every `every` calls
+        if self.calls % self.every == 0:
+            self.write_simulation(simulation)
+        self.calls += 1
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        # The last chunk keeps its preallocated size, n_frames in the index tells how much is valid
+        self.chunk_arrays = None
+        self.check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SnapshotReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks = {}
+        self.refresh()
+
+    def refresh(self):
+        # Picks up the frames written since (the writer can still be running)
+        with open(os.path.join(self.path, "index.json")) as f:
+            self.index = json.load(f)
+        self.N = self.index["N"]
+        self.frames_per_chunk = self.index["frames_per_chunk"]
+        self.n_frames = self.index["n_frames"]
+        self.steps = np.array(self.index["steps"], dtype=np.int64)
+        self.times = np.array(self.index["times"])
+
+    def __len__(self):
+        return self.n_frames
+
+    def chunk_arrays(self, chunk: int):
+        if chunk not in self.chunks:
+            self.chunks[chunk] = tuple(
+                np.load(chunk_path(self.path, name, chunk), mmap_mode="r") for name in ("positions", "velocities")
+            )
+        return self.chunks[chunk]
+
+    def frame(self, i: int):
+        # (positions, velocities) of frame i as read only memory-mapped (N, 3) arrays
+        if i < 0:
+            i += self.n_frames
+        if not 0 <= i < self.n_frames:
+            raise IndexError(f"Frame {i} out of range, {self.n_frames} frames")
+        chunk, offset = divmod(i, self.frames_per_chunk)
+        positions, velocities = self.chunk_arrays(chunk)
+        return positions[offset], velocities[offset]
+
+    def positions(self, i: int) -> np.ndarray:
+        return self.frame(i)[0]
+
+    def velocities(self, i: int) -> np.ndarray:
+        return self.frame(i)[1]
+
+    def __getitem__(self, i: int):
+        return self.frame(i)
@@ -0,0 +1,53 @@
+import csv
+import json
+
+import psutil
+
+from .. import benchmark_suite
+
+
+def test_sweep_writes_results(tmp_path):
+    assert benchmark_suite.main(["--functions", "numpy", "--n-min", "10", "--n-max", "20", "--steps", "2", "--repetitions", "1", "--output", str(tmp_path)]) == 0
+
+    results = json.loads((tmp_path / "results.json").read_text())
+    assert [r["N"] for r in results] == [10, 20]
+    assert all(r["status"] == "ok" and r["peak_rss_mb"] > 0 for r in results)
+
+    with open(tmp_path / "results.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert rows[0]["function"] == "numpy"
+    assert (tmp_path / "time_comparison.png").exists()
+    assert (tmp_path / "space_comparison.png").exists()
+
+
+def test_default_functions(tmp_path, monkeypatch):
+    # Without --functions every available function is benchmarked, only checks that they are found
+    called = []
+    monkeypatch.setattr(benchmark_suite, "verify_complexity", lambda function_name, n_values, **limits: called.append(function_name) or [])
+    assert benchmark_suite.main(["--n-min", "10", "--n-max", "20", "--steps", "2", "--no-plots", "--output", str(tmp_path)]) == 0
+    assert "numpy" in called and "numpy_tiled" in called
+
+
+def test_stops_at_time_limit():
+    results = benchmark_suite.verify_complexity("naive_loops", [10, 10**5, 10**6], max_time_sec=0, repetitions=1)
+    assert [r["status"] for r in results] == ["ok", "time_limit"]
+
+
+def test_weak_scaling(tmp_path):
+    assert benchmark_suite.main(["--scaling", "weak", "--workers", "1", "2", "--n", "100", "--repetitions", "1", "--output", str(tmp_path), "--max-time", "60"]) == 0
+
+    results = json.loads((tmp_path / "scaling.json").read_text())
+    # Same interactions per worker
+    assert [(r["workers"], r["N"]) for r in results] == [(1, 100), (2, 141)]
+    assert all(r["status"] == "ok" for r in results)
+    assert results[0]["speedup"] == 1.0 and results[0]["efficiency"] == 1.0
+    assert (tmp_path / "weak_scaling.png").exists()
+
+
+def test_time_limit_kills_workers():
+    # The worker processes of the distributed function go with it
+    before = set(psutil.pids())
+    result = benchmark_suite.time_algorithm_with_limits("distributed", 10**6, max_time_sec=0, repetitions=1, extra_args=["--workers", "2"])
+    assert result["status"] == "time_limit"
+    workers = [p for p in psutil.process_iter(["pid", "cmdline"]) if p.info["pid"] not in before and "spawn_main" in " ".join(p.info["cmdline"] or [])]
+    assert workers == []
@@ -0,0 +1,352 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+import taichi as ti
+
+import pytest
+
+# The simulation modules import each other by name from src/taichi
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "taichi"))
+import taichi_gravity
+import plummer_model
+import taichi_headless
+import taichi_snapshots
+import taichi_checkpoint
+import taichi_diagnostics
+import taichi_replay
+import taichi_capture
+
+
+def new_simulation(N=64, **kwargs):
+    simulation = taichi_gravity.Simulation(N=N, arch=ti.cpu, **kwargs)
+    simulation.init_bodies_plummer(seed=1)
+    return simulation
+
+
+def test_simulations_coexist():
+    first = new_simulation(100)
+    positions = first.positions.to_numpy()
+    second = new_simulation(200)
+    second.step()
+    np.testing.assert_array_equal(first.positions.to_numpy(), positions)
+
+    # Taichi is only initialized once, another arch can't be used anymore
+    with pytest.raises(RuntimeError):
+        taichi_gravity.Simulation(N=10, arch=ti.vulkan)
+
+
+def test_tiled_matches_direct():
+    direct = new_simulation(100, force_kernel="direct")
+    tiled = new_simulation(100, force_kernel="tiled")
+    for simulation in (direct, tiled):
+        for _ in range(3):
+            simulation.step()
+    np.testing.assert_allclose(tiled.positions.to_numpy(), direct.positions.to_numpy(), rtol=1e-04, atol=1e-05)
+
+
+def test_tiled_needs_softening():
+    with pytest.raises(ValueError):
+        taichi_gravity.Simulation(N=10, arch=ti.cpu, softening=0.0, force_kernel="tiled")
+
+
+def test_snapshots_round_trip(tmp_path):
+    rng = np.random.default_rng(5)
+    frames = [(rng.random((10, 3)), rng.random((10, 3))) for _ in range(5)]
+    with taichi_snapshots.SnapshotWriter(str(tmp_path), 10, frames_per_chunk=2) as writer:
+        for step, (positions, velocities) in enumerate(frames[:4]):
+            writer.write(positions, velocities, step * 10, step * 1.0)
+
+    # A restart from step 20 overwrites the frames after it, inside a chunk that already exists
+    with taichi_snapshots.SnapshotWriter(str(tmp_path), 10, frames_per_chunk=2, resume_step=20) as writer:
+        writer.write(*frames[4], 30, 3.0)
+
+    reader = taichi_snapshots.SnapshotReader(str(tmp_path))
+    assert len(reader) == 4
+    assert reader.steps.tolist() == [0, 10, 20, 30]
+    for i, (positions, velocities) in enumerate(frames[:3] + frames[4:]):
+        np.testing.assert_array_equal(reader.positions(i), positions.astype(np.float32))
+        np.testing.assert_array_equal(reader.velocities(i), velocities.astype(np.float32))
+
+
+def test_prefetcher_frames(tmp_path):
+    rng = np.random.default_rng(6)
+    with taichi_snapshots.SnapshotWriter(str(tmp_path), 20, frames_per_chunk=4) as writer:
+        for step in range(10):
+            writer.write(rng.random((20, 3)), rng.random((20, 3)), step, step * 1.0)
+    reader = taichi_snapshots.SnapshotReader(str(tmp_path))
+    prefetcher = taichi_replay.FramePrefetcher(reader, decimate=3, depth=2)
+    # Forward, backward and jumps that are not prefetched
+    for i, direction in [(0, 1), (1, 1), (2, 1), (9, -1), (8, -1), (3, 1), (7, -1), (5, 1), (5, -1)]:
+        np.testing.assert_array_equal(prefetcher.get(i, direction), reader.positions(i)[::3])
+        assert len(prefetcher.frames) <= 2 * prefetcher.depth + 1
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+
+
+@pytest.mark.parametrize("args, steps", [
+    (["--steps", "5", "--snapshot-every", "1"], [0, 1, 2, 3, 4, 5]),
+    (["--steps", "8", "--snapshot-every", "4", "--integrator", "kdk", "--steps-per-call", "4"], [0, 4, 8]),
+])
+def test_headless_snapshots_every_step(tmp_path, args, steps):
+    # The first call (compile, not timed) writes its outputs like the others
+    snapshot_dir = str(tmp_path / "snapshots")
+    assert taichi_headless.main(["--n", "32", "--arch", "cpu", "--seed", "1", "--snapshot-dir", snapshot_dir] + args) == 0
+    assert taichi_snapshots.SnapshotReader(snapshot_dir).steps.tolist() == steps
+
+
+@pytest.mark.parametrize("integrator", taichi_gravity.integrators)
+def test_checkpoint_round_trip(tmp_path, integrator):
+    # A run restarted from the checkpoint continues bit for bit like the original one
+    path = str(tmp_path / "checkpoint.npz")
+    simulation = new_simulation(64, integrator=integrator, sort_every=2)
+    for _ in range(3):
+        simulation.step()
+    taichi_checkpoint.save_checkpoint(path, simulation)
+    for _ in range(3):
+        simulation.step()
+
+    restored = taichi_checkpoint.restore_simulation(path, arch=ti.cpu)
+    assert (restored.steps, restored.reordered) == (3, True)
+    assert restored.time == pytest.approx(3 * simulation.dt)
+    for _ in range(3):
+        restored.step()
+    np.testing.assert_array_equal(restored.positions.to_numpy(), simulation.positions.to_numpy())
+    np.testing.assert_array_equal(restored.velocities.to_numpy(), simulation.velocities.to_numpy())
+    np.testing.assert_array_equal(restored.ids.to_numpy(), simulation.ids.to_numpy())
+
+
+def test_checkpoint_of_another_simulation(tmp_path):
+    path = str(tmp_path / "checkpoint.npz")
+    taichi_checkpoint.save_checkpoint(path, new_simulation(64))
+    for other in (new_simulation(32), new_simulation(64, dt=0.05), new_simulation(64, integrator="kdk")):
+        positions = other.positions.to_numpy()
+        with pytest.raises(ValueError):
+            taichi_checkpoint.load_checkpoint(path, other)
+        np.testing.assert_array_equal(other.positions.to_numpy(), positions)
+
+
+def test_plummer_reproducible_across_chunks(tmp_path):
+    # The same (N, seed) whatever the chunks, N spans a few blocks of random streams
+    N = 2 * plummer_model.BLOCK_SIZE + 100
+    positions, velocities = plummer_model.generate(N, seed=3)
+    for chunk_size in (plummer_model.BLOCK_SIZE, 2 * plummer_model.BLOCK_SIZE):
+        R, V = plummer_model.generate_to_memmap(str(tmp_path / f"chunks_{chunk_size}"), N, 3, chunk_size)
+        np.testing.assert_array_equal(R, positions)
+        np.testing.assert_array_equal(V, velocities)
+    assert not np.array_equal(plummer_model.generate(N, seed=4)[0], positions)
+
+
+def test_plummer_cache_needs_seed(tmp_path):
+    simulation = taichi_gravity.Simulation(N=64, arch=ti.cpu)
+    simulation.init_bodies_plummer(cache_dir=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+    simulation.init_bodies_plummer(seed=2, cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_device_plummer_finite():
+    # Seeds 8 and 34 draw u = 1 - 2^-24 for one of the first 600000 stars (r = inf before the clamp)
+    simulation = taichi_gravity.Simulation(N=600_000, arch=ti.cpu)
+    for seed in range(40):
+        simulation.init_bodies_plummer_device(seed)
+        positions = simulation.positions.to_numpy()
+        assert np.isfinite(positions).all() and np.isfinite(simulation.velocities.to_numpy()).all(), seed
+    # Half of the mass inside r = 1 / sqrt(2^(2/3) - 1)
+    half_mass_radius = 1 / np.sqrt(2 ** (2 / 3) - 1)
+    assert np.median(np.linalg.norm(positions, axis=1)) == pytest.approx(half_mass_radius, rel=0.01)
+
+
+@pytest.mark.parametrize("integrator", ["dkd", "kdk"])
+def test_mesh_diagnostics_use_mesh_potential(integrator):
+    # Every sample of a pm run, the first one included, has the potential of the mesh
+    simulation = new_simulation(500, integrator=integrator, force_kernel="pm", softening=1e-2)
+    diagnostics = taichi_diagnostics.Diagnostics(simulation, every=1)
+    diagnostics.sample()
+    _, potentials = simulation.run_particle_mesh(True)
+    assert diagnostics.latest()["potential"] == pytest.approx(np.sum(potentials) / 2 / simulation.N, rel=1e-05)
+
+    simulation.step()
+    assert simulation.pair_interactions() == 0
+
+
+def test_sort_morton_permutation():
+    simulation = new_simulation(500)
+    positions = simulation.positions.to_numpy()
+    velocities = simulation.velocities.to_numpy()
+    labels = ti.field(dtype=ti.i32, shape=simulation.N)
+    labels.from_numpy(np.arange(simulation.N, dtype=np.int32) * 7)
+    simulation.attach_field(labels)
+    simulation.sort_morton()
+
+    ids = simulation.ids.to_numpy()
+    assert np.array_equal(np.sort(ids), np.arange(simulation.N)) and simulation.reordered
+    assert np.all(np.diff(simulation.morton_keys.to_numpy().astype(np.float64)) >= 0)
+    # Every field moved with its star
+    np.testing.assert_array_equal(simulation.positions.to_numpy(), positions[ids])
+    np.testing.assert_array_equal(labels.to_numpy(), ids * 7)
+    np.testing.assert_array_equal(simulation.to_original_order(simulation.positions.to_numpy()), positions)
+    np.testing.assert_array_equal(simulation.to_original_order(simulation.velocities.to_numpy()), velocities)
+
+    # Sorted stars are closer to the next one than in random order
+    gap = lambda X: np.median(np.linalg.norm(np.diff(X, axis=0), axis=1))
+    assert gap(simulation.positions.to_numpy()) < gap(positions) / 2
+
+
+def test_kdk_steps_per_call():
+    # One launch of 4 steps is 4 launches of 1 step, and both are close to dkd (same leapfrog)
+    kwargs = dict(dt=0.01, softening=1e-2)
+    fused = new_simulation(100, integrator="kdk", steps_per_call=4, **kwargs)
+    single = new_simulation(100, integrator="kdk", **kwargs)
+    dkd = new_simulation(100, integrator="dkd", **kwargs)
+    fused.step()
+    for _ in range(4):
+        single.step()
+        dkd.step()
+    assert fused.steps == single.steps == 4
+    np.testing.assert_allclose(fused.positions.to_numpy(), single.positions.to_numpy(), rtol=1e-06, atol=1e-06)
+    np.testing.assert_allclose(fused.velocities.to_numpy(), single.velocities.to_numpy(), rtol=1e-06, atol=1e-06)
+    np.testing.assert_allclose(fused.positions.to_numpy(), dkd.positions.to_numpy(), rtol=1e-03, atol=1e-03)
+
+    with pytest.raises(ValueError):
+        taichi_gravity.Simulation(N=10, arch=ti.cpu, integrator="kdk", steps_per_call=taichi_gravity.max_steps_per_call + 1)
+
+
+def test_block_single_level_is_kdk():
+    # With one level every star does a kdk step of dt
+    kwargs = dict(dt=0.01, softening=1e-2)
+    block = new_simulation(100, integrator="block", max_level=0, **kwargs)
+    kdk = new_simulation(100, integrator="kdk", **kwargs)
+    for _ in range(5):
+        block.step()
+        kdk.step()
+    np.testing.assert_allclose(block.positions.to_numpy(), kdk.positions.to_numpy(), rtol=1e-05, atol=1e-05)
+    np.testing.assert_allclose(block.velocities.to_numpy(), kdk.velocities.to_numpy(), rtol=1e-05, atol=1e-05)
+
+
+def test_block_steps_energy_and_interactions():
+    N = 500
+    steps = 20
+    simulation = new_simulation(N, integrator="block", max_level=4, dt=0.05, track_potential=True)
+    diagnostics = taichi_diagnostics.Diagnostics(simulation, every=1)
+    diagnostics.sample()
+    for _ in range(steps):
+        simulation.step()
+        diagnostics.after_step()
+    assert abs(diagnostics.latest()["energy_drift"]) < 1e-04
+    levels = simulation.levels.to_numpy()
+    assert levels.min() == 0 and levels.max() > 0
+    # Only the stars ending their step get forces: fewer than every star at every substep of dt / 2^max_level
+    assert steps * N * N < simulation.pair_interactions() < steps * 2**4 * N * N
+
+
+@pytest.mark.parametrize("integrator, track_potential", [("kdk", True), ("kdk", False), ("dkd", False)])
+def test_diagnostics_match_numpy(integrator, track_potential):
+    # The potential stored by the force kernel (kdk with track_potential) and the O(N^2) fallback
+    N = 300
+    simulation = new_simulation(N, integrator=integrator, track_potential=track_potential, softening=1e-2)
+    simulation.step()
+    diagnostics = taichi_diagnostics.Diagnostics(simulation)
+    diagnostics.sample()
+    sample = diagnostics.latest()
+
+    positions = simulation.positions.to_numpy().astype(np.float64)
+    velocities = simulation.velocities.to_numpy().astype(np.float64)
+    distance = np.sqrt(np.sum((positions[:, np.newaxis] - positions) ** 2, axis=2) + simulation.softening)
+    np.fill_diagonal(distance, np.inf)
+    center_of_mass = positions.mean(axis=0)
+    assert sample["time"] == pytest.approx(simulation.time)
+    assert sample["kinetic"] == pytest.approx(0.5 * np.sum(velocities**2) / N, rel=1e-05)
+    assert sample["potential"] == pytest.approx(-0.5 * np.sum(1 / distance) / N**2, rel=1e-05)
+    np.testing.assert_allclose(sample["momentum"], velocities.mean(axis=0), atol=1e-06)
+    np.testing.assert_allclose(sample["center_of_mass"], center_of_mass, atol=1e-06)
+    # Histogram bins of 2.7%
+    radii = np.linalg.norm(positions - center_of_mass, axis=1)
+    np.testing.assert_allclose(sample["lagrangian_radii"], np.quantile(radii, diagnostics.mass_fractions), rtol=0.03)
+
+
+def test_capture_png_frames(tmp_path):
+    import matplotlib.image
+    rng = np.random.default_rng(7)
+    # Indexed [x, y] from the bottom left like get_image_buffer_as_numpy()
+    buffers = [rng.random((6, 4, 4)).astype(np.float32) for _ in range(5)]
+    capture = taichi_capture.FrameCapture(str(tmp_path / "frames"), block=True)
+    for buffer in buffers:
+        capture.capture_buffer(buffer)
+    capture.close()
+    assert (capture.written, capture.dropped) == (5, 0)
+    assert sorted(os.listdir(tmp_path / "frames")) == [f"frame_{i:04d}.png" for i in range(5)]
+    for i, buffer in enumerate(buffers):
+        image = np.round(matplotlib.image.imread(str(tmp_path / "frames" / f"frame_{i:04d}.png"))[..., :3] * 255).astype(np.uint8)
+        np.testing.assert_array_equal(image, taichi_capture.to_rgb8(buffer))
+        # Rows from the top, the bottom left pixel of the buffer is in the last row
+        assert image.shape == (4, 6, 3)
+        np.testing.assert_array_equal(image[-1, 0], (buffer[0, 0, :3] * 255).astype(np.uint8))
+
+
+def test_capture_drops_when_full(tmp_path):
+    # Without workers nothing leaves the queue
+    capture = taichi_capture.FrameCapture(str(tmp_path / "frames"), max_queue=2, png_workers=0)
+    for i in range(5):
+        capture.capture_buffer(np.zeros((4, 4, 4), dtype=np.float32))
+        assert (capture.backlog, capture.dropped) == (min(i + 1, 2), max(i - 1, 0))
+    capture.close()
+
+
+def test_capture_reports_dead_ffmpeg(tmp_path, monkeypatch, capsys):
+    def start_ffmpeg(self, height, width):
+        self.process = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"], stdin=subprocess.PIPE)
+        self.process.wait()
+
+    monkeypatch.setattr(taichi_capture.shutil, "which", lambda name: name)
+    monkeypatch.setattr(taichi_capture.FrameCapture, "start_ffmpeg", start_ffmpeg)
+    capture = taichi_capture.FrameCapture(str(tmp_path / "video.mp4"), block=True)
+    for _ in range(3):
+        capture.capture_buffer(np.zeros((256, 256, 4), dtype=np.float32))
+    capture.close()
+    assert isinstance(capture.error, BrokenPipeError)
+    assert "ffmpeg exited with 3" in capsys.readouterr().out
+
+
+shared_runtime_code = """
+import sys
+import numpy as np
+import taichi as ti
+sys.path.append("taichi")
+import accelerations
+import taichi_gravity
+
+accelerations.set_taichi_arch("cpu")
+X = np.random.default_rng(8).random((50, 3))
+expected = accelerations.compute_accelerations(X, softening=0.1)
+def check_accelerations():
+    result = accelerations.compute_accelerations(X, softening=0.1, backend="taichi", dtype=np.float32)
+    np.testing.assert_allclose(result, expected, rtol=1e-04, atol=1e-04)
+
+if sys.argv[1] == "accelerations":
+    check_accelerations()
+simulation = taichi_gravity.Simulation(N=64, arch=ti.cpu)
+simulation.init_bodies_plummer(seed=1)
+positions = simulation.positions.to_numpy()
+check_accelerations()
+taichi_gravity.Simulation(N=8)
+np.testing.assert_array_equal(simulation.positions.to_numpy(), positions)
+simulation.step()
+assert np.isfinite(simulation.positions.to_numpy()).all()
+check_accelerations()
+try:
+    taichi_gravity.Simulation(N=8, arch=ti.vulkan)
+except RuntimeError:
+    print("mismatch")
+"""
+
+
+@pytest.mark.parametrize("first", ["accelerations", "simulation"])
+def test_simulation_and_accelerations_share_taichi(first):
+    # A fresh interpreter, in this one taichi is already initialized by the other tests.
+    # Neither initializes taichi again (which frees the fields of the other) and another arch is an error
+    result = subprocess.run([sys.executable, "-c", shared_runtime_code, first], cwd=os.path.dirname(taichi_gravity.__file__) + "/..",
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == "mismatch"